@@ -0,0 +1,69 @@
+"""
+Time from unwrapped pages to the result of a simple aggregation.
+sqlite - the table is created with the columns the query needs, pages are inserted and the query runs.
+columnar - `aggregate_columns` over the same pages(needs the `columnar` extra).
+Run from the repository root: `python -m benchmarks.columnar_aggregate`
+"""
+import random
+import sqlite3
+import timeit
+
+from src.core.columnar import aggregate_columns
+from src.core.db import create_table, insert_rows, get_aggregate
+from src.core.query import match_group_aggregate, prune_columns
+from src.core.warehouse import EVENT_COLUMNS
+
+QUERIES = [
+    "SELECT currency_id, SUM(effect), COUNT(*) FROM data GROUP BY currency_id",
+    "SELECT extra, AVG(effect) FROM data GROUP BY extra",
+    "SELECT SUM(effect), MIN(block), MAX(block) FROM data",
+]
+
+
+def make_pages(rows_count: int, page_size: int = 1000) -> list[list[dict]]:
+    currencies = [f"ethereum-erc-20/0x{random.getrandbits(160):040x}" for _ in range(50)]
+    rows = [
+        {
+            "block": 22251555 - i // 10,
+            "transaction_hash": f"0x{random.getrandbits(256):064x}",
+            "time": "2025-04-12 10:11:12",
+            "currency_id": random.choice(currencies),
+            "effect": str(random.randrange(-10 ** 20, 10 ** 20)),
+            "failed": False,
+            "extra": random.choice([None, None, None, "f", "b"]),
+            "currency_symbol": "USDT",
+            "currency_verified": True,
+            "currency_decimals": 6,
+            "exchange_rate": 1.0,
+        }
+        for i in range(rows_count)
+    ]
+    return [rows[i:i + page_size] for i in range(0, rows_count, page_size)]
+
+
+def sqlite_aggregate(pages: list[list[dict]], sql_query: str):
+    keys = prune_columns(EVENT_COLUMNS, sql_query)
+    conn = sqlite3.connect(":memory:")
+    create_table(conn, keys)
+    for page in pages:
+        insert_rows(conn, keys, page)
+    conn.commit()
+    rows = get_aggregate(conn, sql_query).rows
+    conn.close()
+    return rows
+
+
+def columnar_aggregate(pages: list[list[dict]], sql_query: str):
+    return aggregate_columns(pages, EVENT_COLUMNS, match_group_aggregate(sql_query, EVENT_COLUMNS))
+
+
+if __name__ == '__main__':
+    for rows_count in (10_000, 30_000, 100_000):
+        pages = make_pages(rows_count)
+        for sql_query in QUERIES:
+            timings = []
+            for name, fn in [("sqlite", sqlite_aggregate), ("columnar", columnar_aggregate)]:
+                timings.append(min(timeit.repeat(lambda: fn(pages, sql_query), number=1, repeat=5)))
+            print(f"{rows_count} rows, {sql_query}\n"
+                  f"    sqlite: {timings[0] * 1000:.1f} ms, columnar: {timings[1] * 1000:.1f} ms, "
+                  f"x{timings[0] / timings[1]:.1f}")
@@ -0,0 +1,54 @@
+"""
+Per-page CPU cost of decoding an API response with 1000 events.
+before - CustomClient parsed the body, re-serialized it without `context`, and callers parsed it again.
+after - body is decoded once by `decode_payload`.
+Run from the repository root: `python -m benchmarks.decode_page`
+"""
+import json
+import random
+import timeit
+
+from src.core.client import decode_payload, json_loads
+
+
+def make_page(events_count: int = 1000) -> bytes:
+    events = [
+        {
+            "block": 22251555 - i // 10,
+            "transaction": f"0x{random.getrandbits(256):064x}",
+            "sort_key": i,
+            "time": "2025-04-12T10:11:12.000000Z",
+            "currency": "ethereum-erc-20/0xdac17f958d2ee523a2206206994597c13d831ec7",
+            "effect": str(random.getrandbits(64)),
+            "failed": False,
+            "extra": None,
+            "extra_indexed": None,
+        }
+        for i in range(events_count)
+    ]
+    payload = {
+        "data": {"events": {"ethereum-erc-20": events}},
+        "library": {"currencies": {}, "rates": {}},
+        "context": {"code": 200, "limits": {}, "time": 0.1},
+    }
+    return json.dumps(payload).encode()
+
+
+def decode_before(content: bytes) -> dict:
+    response_json = json.loads(content)
+    del response_json['context']
+    content = json.dumps(response_json)
+    return json.loads(content)
+
+
+def decode_after(content: bytes) -> dict:
+    return decode_payload(content)
+
+
+if __name__ == '__main__':
+    page = make_page()
+    rounds = 50
+    print(f"page size: {len(page) / 1024:.0f} KiB, json backend: {json_loads.__module__}")
+    for name, fn in [("before", decode_before), ("after", decode_after)]:
+        per_page = min(timeit.repeat(lambda: fn(page), number=rounds, repeat=5)) / rounds
+        print(f"{name}: {per_page * 1000:.2f} ms per page")
@@ -1,31 +1,127 @@
+import asyncio
 import json
 import logging
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
 
-from httpx import AsyncClient
+from httpx import AsyncClient, Response, Limits, Timeout, HTTPError
 
 from src.core.config import config
+from src.core.scheduler import request_scheduler, request_priority
+
+try:  # optional faster backend
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:  # optional HTTP/2 support, `http2` extra
+    import h2  # noqa: F401
+
+    http2_available = True
+except ImportError:
+    http2_available = False
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
+RETRIED_STATUSES = {429, 502, 503, 504}
+# timeouts by endpoint class, pages of 1000 events take longer to build and download than overviews
+OVERVIEW_TIMEOUT = Timeout(config.http_read_timeout, connect=config.http_connect_timeout)
+PAGES_TIMEOUT = Timeout(config.http_pages_read_timeout, connect=config.http_connect_timeout)
+
+
+def retry_after(response: Response) -> Optional[float]:
+    """
+    Seconds to wait from the `Retry-After` header, either seconds or an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
 class CustomClient(AsyncClient):
+    """
+    Requests are paced by `request_scheduler` with the priority of the calling context,
+    rate limited and unavailable responses are retried with exponential backoff.
+    Compressed responses are negotiated for every encoding httpx can decode(`compression` extra adds brotli, zstd).
+    """
+
+    def __init__(self, *args, http2: bool = False, **kwargs):
+        super().__init__(*args, http2=http2, **kwargs)
+        self.http2 = http2
+        self.downloaded_bytes = 0  # as transferred, compressed
+        self.decoded_bytes = 0
+
     async def request(self, method, url, *args, **kwargs):
         params = kwargs.get('params')
         if params is None:
             params = dict()
         params['token'] = config.threexpl_api_key
         kwargs['params'] = params
-        logger.debug(f"Request URL: {url}")
-        response = await super().request(method, url, *args, **kwargs)
-        saved_content = response.content
+        for attempt in range(config.api_max_retries + 1):
+            await request_scheduler.acquire(request_priority.get())
+            logger.debug(f"Request URL: {url}")
+            response = await super().request(method, url, *args, **kwargs)
+            self.downloaded_bytes += response.num_bytes_downloaded
+            self.decoded_bytes += len(response.content)
+            if response.status_code not in RETRIED_STATUSES or attempt == config.api_max_retries:
+                return response
+
+            delay = retry_after(response)
+            if delay is None:  # jitter keeps retries of parallel requests apart
+                delay = config.api_retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            delay = min(delay, config.api_retry_max_delay)
+            if response.status_code == 429:
+                request_scheduler.throttle(delay)
+            logger.warning(f"Got {response.status_code} for {url}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def preconnect(self):
+        """
+        Opens a connection to the API(TLS handshake included) ahead of the first tool call.
+        """
         try:
-            response_json = response.json()
-            del response_json['context']
-            response._content = json.dumps(response_json)
-        except (json.JSONDecodeError, KeyError):  # rollback
-            response._content = saved_content
-        return response
+            await super().request("HEAD", config.threexpl_api_base_url)
+        except HTTPError as e:
+            logger.warning(f"Failed to pre-connect to the API: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "http_version": "HTTP/2" if self.http2 else "HTTP/1.1",
+            "downloaded_bytes": self.downloaded_bytes,
+            "decoded_bytes": self.decoded_bytes,
+        }
+
+
+def decode_payload(content: bytes) -> dict:
+    """
+    Decodes API response body once, dropping the `context` section nobody uses.
+    """
+    payload = json_loads(content)
+    if isinstance(payload, dict):
+        payload.pop('context', None)
+    return payload
 
 
-client = CustomClient(timeout=5)  # reusable client
+if config.http2_enabled and not http2_available:
+    logger.warning("HTTP/2 needs the `http2` extra, using HTTP/1.1")
+client = CustomClient(  # reusable client
+    http2=config.http2_enabled and http2_available,
+    limits=Limits(max_connections=config.http_max_connections,
+                  max_keepalive_connections=config.http_max_keepalive_connections,
+                  keepalive_expiry=config.http_keepalive_expiry),
+    timeout=OVERVIEW_TIMEOUT,
+)
@@ -0,0 +1,99 @@
+from typing import Optional
+
+from src.core.query import GroupAggregate
+
+try:
+    import numpy as np
+except ImportError:  # optional, `columnar` extra
+    np = None
+
+
+def _numeric_column(rows: list[dict], column: str, type_: str):
+    """
+    Values of a numeric column as an array and a mask of non-null ones,
+    None if some value wouldn't be stored by SQLite as a plain number.
+    """
+    values = [row.get(column) for row in rows]
+    mask = np.fromiter((value is not None for value in values), dtype=bool, count=len(values))
+    present = [value for value in values if value is not None] if None in values else values
+    value_types = set(map(type, present))
+    if type_ == "REAL" and value_types <= {int, float, str}:  # amounts come as strings of digits
+        dtype = np.float64
+    elif type_ != "REAL" and value_types <= {int, bool}:
+        dtype = np.int64
+    else:
+        return None
+    array = np.zeros(len(values), dtype=dtype)
+    try:
+        array[mask] = np.array(present, dtype=dtype)
+    except (ValueError, OverflowError):  # not a number at all
+        return None
+    if dtype == np.float64 and not np.isfinite(array).all():  # SQLite keeps `nan` or `inf` strings as text
+        return None
+    return array, mask
+
+
+def aggregate_columns(pages: list[list[dict]], keys: dict, query: GroupAggregate) -> Optional[list[tuple]]:
+    """
+    Runs a recognized query over fetched pages with vectorized group-by kernels:
+    group keys are dictionary encoded, numeric columns are NumPy arrays.
+    Rows come out the way SQLite returns them: groups sorted by key, NULL first, same types of values.
+    Float sums may differ from SQLite in the last digits.
+    None if values don't fit the column types, the query has to go to SQLite then.
+    """
+    rows = [row for page in pages for row in page]
+    if query.group_by is not None:
+        group_index = {}
+        codes = np.fromiter((group_index.setdefault(row.get(query.group_by), len(group_index)) for row in rows),
+                            dtype=np.int64, count=len(rows))
+        group_keys = list(group_index)
+        if not all(key is None or isinstance(key, str) for key in group_keys):
+            return None
+        order = sorted(range(len(group_keys)), key=lambda i: (group_keys[i] is not None, group_keys[i] or ""))
+    else:
+        codes = np.zeros(len(rows), dtype=np.int64)
+        group_keys = [None]
+        order = [0]
+    groups = len(group_keys)
+
+    numeric_columns = {}
+    for fn, column in query.outputs:
+        if fn not in (None, "count") and column is not None and column not in numeric_columns:
+            numeric_columns[column] = _numeric_column(rows, column, keys[column])
+            if numeric_columns[column] is None:
+                return None
+
+    outputs = []
+    for fn, column in query.outputs:
+        if fn is None:
+            outputs.append(group_keys)
+            continue
+        if column is None:
+            outputs.append(np.bincount(codes, minlength=groups).tolist())
+            continue
+        if column in numeric_columns:
+            values, mask = numeric_columns[column]
+        else:
+            values, mask = None, np.fromiter((row.get(column) is not None for row in rows), dtype=bool, count=len(rows))
+        counts = np.bincount(codes[mask], minlength=groups).tolist()
+        if fn == "count":
+            outputs.append(counts)
+            continue
+
+        if fn in ("sum", "total", "avg"):
+            sums = np.zeros(groups, dtype=values.dtype)
+            np.add.at(sums, codes[mask], values[mask])
+            if fn == "total":
+                outputs.append(sums.astype(np.float64).tolist())
+                continue
+            result = sums.tolist()
+            if fn == "avg":
+                result = [total / count if count else None for total, count in zip(result, counts)]
+        else:
+            limits = np.finfo(np.float64) if values.dtype == np.float64 else np.iinfo(np.int64)
+            extremes = np.full(groups, limits.max if fn == "min" else limits.min, dtype=values.dtype)
+            (np.minimum if fn == "min" else np.maximum).at(extremes, codes[mask], values[mask])
+            result = extremes.tolist()
+        # aggregates of no values are NULL
+        outputs.append([value if count else None for value, count in zip(result, counts)])
+    return [tuple(output[group] for output in outputs) for group in order]
@@ -9,6 +9,79 @@ class Config(BaseSettings):
     threexpl_api_key: str = ""
     threexpl_api_base_url: str = "https://api.3xpl.com"
     pagination_limit: int = 25
+    pagination_concurrency: int = 8  # max page requests in flight per collection
+    segment_concurrency: int = 4  # max address segments fetched at once
+    block_range_concurrency: int = 8  # max blocks fetched at once by block range aggregations
+    block_range_max_blocks: int = 1000
+    address_batch_concurrency: int = 4  # max addresses fetched at once by batch aggregations
+    address_batch_max_addresses: int = 50
+    module_concurrency: int = 4  # max modules fetched at once when aggregating all modules of a blockchain
+    # cross-chain overview, blockchains which don't answer in time are reported instead of failing the call
+    cross_chain_concurrency: int = 8
+    cross_chain_timeout: float = 10
+
+    # connections to the API
+    http_max_connections: int = 64
+    http_max_keepalive_connections: int = 32
+    http_keepalive_expiry: float = 30
+    http2_enabled: bool = False  # multiplexes requests over one connection, needs `http2` extra
+    http_connect_timeout: float = 5
+    http_read_timeout: float = 10  # overviews, search and stats
+    http_pages_read_timeout: float = 30  # pages of events, up to 1000 rows each
+
+    # a second attempt starts when an interactive request is slower than that percentile of its endpoint latency,
+    # second attempts are capped at a share of all requests
+    hedging_enabled: bool = False
+    hedging_percentile: float = 95
+    hedging_max_extra_ratio: float = 0.05
+
+    # pacing of API requests, interactive tools are served before bulk pagination. 0 rate is unlimited
+    api_requests_per_second: float = 10
+    api_burst: int = 20
+    # rate limited(429) and unavailable responses are retried, honoring `Retry-After`
+    api_max_retries: int = 3
+    api_retry_backoff: float = 0.5  # first delay without `Retry-After`, doubled on each retry
+    api_retry_max_delay: float = 30
+
+    # response cache, sizes are measured on response bodies
+    response_cache_max_bytes: int = 64 * 1024 * 1024
+    # blocks(and transactions in them) with at least that many confirmations are cached forever
+    finality_confirmations: int = 100
+    cache_ttl_unconfirmed: float = 10
+    cache_ttl_address: float = 15
+    cache_ttl_mempool: float = 1
+    cache_ttl_search: float = 300
+
+    # stats snapshot, polled in background
+    stats_refresh_interval: float = 10
+    stats_max_staleness: float = 60  # older snapshot is refreshed on read
+
+    db_workers: int = 4  # threads running SQLite ingestion and queries
+    auto_index_min_rows: int = 5000  # smaller tables aren't indexed for queries, full scans are fast enough
+    # simple aggregations(e.g. sum of effect by currency) are computed on NumPy columns, needs `columnar` extra
+    columnar_enabled: bool = False
+    # budgets of a single aggregation query, exceeding them aborts the query
+    query_cpu_time_limit: float = 10
+    query_max_steps: int = 1_000_000_000  # SQLite VM instructions, 0 is unlimited
+    # result caps, rows over them are dropped and the result is marked as truncated
+    query_max_rows: int = 1000
+    query_max_result_bytes: int = 256 * 1024
+    # results of aggregation queries, immutable datasets(e.g. confirmed blocks) are cached forever
+    result_cache_max_bytes: int = 16 * 1024 * 1024
+    # processes unwrapping, loading and querying pages, 0 keeps everything in db_workers threads
+    aggregation_workers: int = 0
+    aggregation_worker_max_tasks: int = 100  # worker process is replaced after that many calls
+    # pages sent to workers are held in memory, larger loads go to a dataset as pages arrive
+    aggregation_worker_max_pages: int = 100
+
+    # datasets kept after aggregations for follow-up queries
+    dataset_max_bytes: int = 256 * 1024 * 1024
+    dataset_ttl: float = 600  # idle datasets are closed after that many seconds
+
+    # on-disk store of address events, synced incrementally
+    warehouse_enabled: bool = True
+    warehouse_path: Path = Path.home() / ".cache" / "3xpl-mcp" / "warehouse.sqlite"
+    warehouse_max_bytes: int = 1024 * 1024 * 1024
 
     @field_validator('threexpl_api_base_url', mode='after')
     def set_api_base_url(cls, v, info: ValidationInfo):
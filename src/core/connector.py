@@ -1,8 +1,146 @@
+import asyncio
+import functools
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from typing import Optional
 
-from src.core.client import client
+from httpx import Timeout
+
+from src.core.cache import LRUCache
+from src.core.client import client, decode_payload, OVERVIEW_TIMEOUT, PAGES_TIMEOUT
 from src.core.config import config
 from src.core.enums import AddressDataSource
+from src.core.hedging import RequestHedger
+from src.core.scheduler import Priority, request_priority, request_scheduler
+from src.core.singleflight import SingleFlight
+
+response_cache = LRUCache(config.response_cache_max_bytes)
+in_flight_requests = SingleFlight()
+request_hedger = RequestHedger(config.hedging_enabled, config.hedging_percentile, config.hedging_max_extra_ratio,
+                               congested=lambda: request_scheduler.congested)
+best_blocks: dict[str, int] = {}  # latest seen best block per blockchain
+
+
+def _constant_ttl(ttl: Optional[float]) -> Callable[[dict], Optional[float]]:
+    return lambda payload: ttl
+
+
+def confirmations_ttl(blockchain: str, block: Optional[int]) -> Optional[float]:
+    if not isinstance(block, int) or block < 0:  # not included into a block yet
+        return config.cache_ttl_mempool
+    best_block = best_blocks.get(blockchain)
+    if best_block is not None and best_block - block >= config.finality_confirmations:
+        return None
+    return config.cache_ttl_unconfirmed
+
+
+def remember_best_block(blockchain: str, best_block: Optional[int]):
+    if isinstance(best_block, int) and best_block > best_blocks.get(blockchain, -1):
+        best_blocks[blockchain] = best_block
+
+
+async def _get_json(path: str, params: dict, ttl_policy: Callable[[dict], Optional[float]],
+                    timeout: Timeout = OVERVIEW_TIMEOUT):
+    """
+    GET request to the API through the response cache, coalesced with identical requests in flight.
+    `ttl_policy` gets the decoded payload and tells for how long it can be cached:
+    `None` - forever, 0 - not at all.
+    `timeout` depends on the endpoint class: `OVERVIEW_TIMEOUT` or `PAGES_TIMEOUT`.
+    Interactive requests are hedged against slow responses when hedging is enabled.
+    """
+    # requests share entries only when their params are the same. A block overview(`block` section of all modules)
+    # and pages of block events(`block,events` of one module) ask for different data, so they never share one
+    cache_key = (path, tuple(sorted((key, str(value)) for key, value in params.items())))
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    async def get():
+        response = await client.get(f"{config.threexpl_api_base_url}{path}", params=params, timeout=timeout)
+        response.raise_for_status()
+        return response
+
+    async def request():
+        if request_priority.get() == Priority.interactive:
+            # latencies are told apart by entity type(e.g. `/ethereum/block`) and number of rows
+            response = await request_hedger.run(("/".join(path.split("/")[:3]), params.get("limit")), get)
+        else:
+            response = await get()
+        payload = decode_payload(response.content)
+
+        ttl = ttl_policy(payload)
+        if ttl is None or ttl > 0:
+            response_cache.set(cache_key, payload, len(response.content), ttl)
+        return payload
+
+    # identical requests in flight share one response
+    return await in_flight_requests.do(cache_key, request)
+
+
+@dataclass
+class RequestProfile:
+    """
+    What a caller consumes from an entity endpoint(address, transaction, block),
+    so the API is asked only for that.
+    """
+    sections: tuple[str, ...]  # `data` sections
+    # rows per module the caller reads from listed sections(e.g. `events`), other sections have no rows
+    rows: dict[str, int] = field(default_factory=dict)
+    library: Optional[str] = None
+    modules: str = "all"
+
+    def requests(self) -> list[dict]:
+        """
+        Params of the smallest requests covering the profile.
+        `limit` applies to all sections of a request, so sections needing different number of rows are split.
+        """
+        limits = sorted(set(self.rows.values())) or [None]
+        requests = []
+        for limit in limits:
+            # sections without rows go along with the smallest request
+            params = {"data": ",".join(section for section in self.sections
+                                       if self.rows.get(section, limits[0]) == limit),
+                      "from": self.modules}
+            if limit is not None:
+                params["limit"] = limit
+            if self.library is not None:
+                params["library"] = self.library
+            requests.append(params)
+        return requests
+
+
+def _merge_payloads(payload: dict, other: dict) -> dict:
+    # payloads can be shared through the response cache, so they are merged into new dicts
+    if not isinstance(payload, dict) or not isinstance(other, dict):
+        return other
+    return {**payload, **{key: _merge_payloads(payload[key], value) if key in payload else value
+                          for key, value in other.items()}}
+
+
+async def _get_profile(path: str, profile: RequestProfile, ttl_policy: Callable[[dict], Optional[float]]):
+    """
+    Requests of the profile are sent at once, their payloads are merged into one.
+    """
+    payloads = await asyncio.gather(*(
+        # requests for more than the newest row are pages
+        _get_json(path, params, ttl_policy, PAGES_TIMEOUT if params.get("limit", 0) > 1 else OVERVIEW_TIMEOUT)
+        for params in profile.requests()
+    ))
+    return functools.reduce(_merge_payloads, payloads)
+
+
+# everything an entity endpoint gives, for callers without their own profile
+ADDRESS_PROFILE = RequestProfile(("address", "events", "balances", "mempool", "kya"),
+                                 {"events": 1000, "mempool": 1000}, "currencies,rates(usd)")
+TRANSACTION_PROFILE = RequestProfile(("transaction", "events", "kyt", "special"), {"events": 1000})
+BLOCK_PROFILE = RequestProfile(("block", "events"), {"events": 1000})
+
+
+def _remember_stats_best_blocks(payload: dict) -> float:
+    for blockchain, blockchain_stats in (payload.get('data', {}).get('blockchains') or {}).items():
+        remember_best_block(blockchain, blockchain_stats.get('best_block'))
+    return 0  # stats are kept by the stats snapshot
 
 
 async def fetch_stats(blockchain: Optional[str] = None):
@@ -10,81 +148,28 @@ async def fetch_stats(blockchain: Optional[str] = None):
         "from": "all" if blockchain is None else blockchain,
         "library": "blockchains,modules"
     }
-    response = await client.get(
-        f"{config.threexpl_api_base_url}/",
-        params=params
-    )
-    response.raise_for_status()
-    return response.json()
+    return await _get_json("/", params, _remember_stats_best_blocks)
 
 
 async def search_string(data: str):
     params = {
         "q": data
     }
-    response = await client.get(
-        f"{config.threexpl_api_base_url}/search",
-        params=params
-    )
-    response.raise_for_status()
-    return response.json()
+    return await _get_json("/search", params, _constant_ttl(config.cache_ttl_search))
 
 
-async def fetch_address(blockchain: str, address: str, use_case: str = "address_overview"):
-    params = {
-        "data": "address,events",
-        "limit": 1000,
-        # "page": 0,
-        "from": "all",
-        "library": "currencies,rates(usd)"
-    }
-    if use_case == "segment_lookup":
-        # balances and mempool can not be used with segment
-        # as well as `page` has to be provided.
-        params['segment'] = "?some segment"
-    elif use_case == "address_overview":
-        params["data"] += ",balances,mempool,kya"
-    else:
-        raise ValueError("unknown use_case")
-
-    response = await client.get(
-        f"{config.threexpl_api_base_url}/{blockchain}/address/{address}",
-        params=params,
-    )
-    response.raise_for_status()
-    return response.json()
-
-
-async def fetch_transaction(blockchain: str, transaction_hash: str):
-    params = {
-        "data": "transaction,events,kyt,special",
-        "from": "all",
-        "limit": 1000,  # too high limit though
-        "page": 0,
-        "mixins": "stats"
-    }
-    response = await client.get(
-        f"{config.threexpl_api_base_url}/{blockchain}/transaction/{transaction_hash}",
-        params=params
-    )
-    response.raise_for_status()
+async def fetch_address(blockchain: str, address: str, profile: RequestProfile = ADDRESS_PROFILE):
+    return await _get_profile(f"/{blockchain}/address/{address}", profile, _constant_ttl(config.cache_ttl_address))
 
-    return response.json()
 
+async def fetch_transaction(blockchain: str, transaction_hash: str, profile: RequestProfile = TRANSACTION_PROFILE):
+    return await _get_profile(f"/{blockchain}/transaction/{transaction_hash}", profile,
+                              lambda payload: confirmations_ttl(blockchain, payload['data']['transaction'].get('block')))
 
-async def fetch_block(blockchain: str, height: int):
-    params = {
-        "data": "block,events",
-        "limit": 1000,  # iterate through?
-        "from": "all",
-        "mixins": "stats",
-    }
-    response = await client.get(
-        f"{config.threexpl_api_base_url}/{blockchain}/block/{height}",
-        params=params
-    )
-    response.raise_for_status()
-    return response.json()
+
+async def fetch_block(blockchain: str, height: int, profile: RequestProfile = BLOCK_PROFILE):
+    return await _get_profile(f"/{blockchain}/block/{height}", profile,
+                              lambda payload: confirmations_ttl(blockchain, height))
 
 
 async def fetch_block_events(blockchain: str, module: str, height: int, limit: int = 1000, page: int = 0):
@@ -95,12 +180,8 @@ async def fetch_block_events(blockchain: str, module: str, height: int, limit: i
         "from": module,
         "library": "currencies,rates(usd)",
     }
-    response = await client.get(
-        f"{config.threexpl_api_base_url}/{blockchain}/block/{height}",
-        params=params,
-    )
-    response.raise_for_status()
-    return response.json()
+    return await _get_json(f"/{blockchain}/block/{height}", params,
+                           lambda payload: confirmations_ttl(blockchain, height), PAGES_TIMEOUT)
 
 
 async def fetch_transaction_events(blockchain: str, module: str, transaction_hash: str,
@@ -112,19 +193,14 @@ async def fetch_transaction_events(blockchain: str, module: str, transaction_has
         "from": module,
         "library": "currencies,rates(usd)"
     }
-
-    response = await client.get(
-        f"{config.threexpl_api_base_url}/{blockchain}/transaction/{transaction_hash}",
-        params=params,
-    )
-    response.raise_for_status()
-    return response.json()
+    return await _get_json(f"/{blockchain}/transaction/{transaction_hash}", params,
+                           lambda payload: confirmations_ttl(blockchain, payload['data']['transaction'].get('block')),
+                           PAGES_TIMEOUT)
 
 
 # can be multiple separated, or can be merged though.
 async def fetch_address_data(blockchain: str, module: str, address: str, source: AddressDataSource,
-                             # segment: Optional[str] = None,
-                             limit: int = 1000, page: int = 0):
+                             limit: int = 1000, page: int = 0, segment: Optional[str] = None):
     params = {
         "data": source.value,
         "limit": limit,
@@ -132,15 +208,14 @@ async def fetch_address_data(blockchain: str, module: str, address: str, source:
         "from": module,
         "library": "currencies,rates(usd)",
     }
-    # if segment is not None:
-    #     params["segment"] = segment
+    if segment is not None:
+        # `YYYY-MM` month segment, can't be used with balances and mempool.
+        params["segment"] = segment
 
-    response = await client.get(
-        f"{config.threexpl_api_base_url}/{blockchain}/address/{address}",
-        params=params,
-    )
-    response.raise_for_status()
-    return response.json()
+    ttl = config.cache_ttl_mempool if source == AddressDataSource.mempool else config.cache_ttl_address
+    if segment is not None and segment < datetime.now(timezone.utc).strftime("%Y-%m"):
+        ttl = None  # past months don't get new events
+    return await _get_json(f"/{blockchain}/address/{address}", params, _constant_ttl(ttl), PAGES_TIMEOUT)
 
 
 async def fetch_address_balances(blockchain: str, module: str, address: str, source: AddressDataSource,
@@ -156,7 +231,7 @@ async def fetch_address_balances(blockchain: str, module: str, address: str, sou
         return unwrapped_balance_data
     for currency, currency_info in balances.items():
         unwrapped_balance_data.append({
-            "currency": currency,
+            "currency_id": currency,
             "symbol": currencies_library[currency]["symbol"],
             "decimals": currencies_library[currency]["decimals"],
             "balance": currency_info['balance'],
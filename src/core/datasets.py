@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Callable, Hashable
+from contextlib import aclosing
+from typing import Optional
+
+from src.core.cache import LRUCache
+from src.core.config import config
+from src.core.db import db_executor, setup_sqlite_connection, create_table, insert_rows, get_aggregate, \
+    create_query_indexes, QueryResult
+from src.core.query import prune_columns, referenced_columns
+
+logger = logging.getLogger(__name__)
+
+
+class Dataset:
+    """
+    `data` table in its own in-memory SQLite connection, which can outlive the tool call that loaded it.
+    Calls on the connection run in `db_executor` one at a time, so it can be closed from any thread.
+    Used as an async context manager: the connection is closed on exit unless the dataset was kept in `datasets`.
+    """
+
+    def __init__(self, keys: dict, sql_query: Optional[str] = None, source: Optional[Hashable] = None):
+        """
+        :param keys: all columns of the `data` table.
+        :param sql_query: the only query of a dataset which won't be kept, only columns it needs are loaded.
+            Kept datasets get all columns, so follow-up queries can use any of them.
+        :param source: what the data was loaded from(e.g. blockchain, module and block).
+        """
+        self.dataset_id = secrets.token_hex(8)
+        self.source = source
+        self.schema = keys
+        self.keys = keys if sql_query is None else prune_columns(keys, sql_query)
+        self.conn = setup_sqlite_connection()
+        self.size = 0
+        self.last_access = time.monotonic()
+        self.closed = False
+        self.kept = False
+        self._lock = threading.Lock()
+
+    async def __aenter__(self) -> "Dataset":
+        return self
+
+    async def __aexit__(self, *_):
+        if not self.kept:
+            await db_executor.run(self.close)
+
+    def _call(self, fn: Callable, *args):
+        with self._lock:
+            if self.closed:
+                raise ValueError(f"Dataset {self.dataset_id} is closed")
+            self.last_access = time.monotonic()
+            return fn(self.conn, *args)
+
+    async def run(self, fn: Callable, *args):
+        """
+        Runs `fn(conn, *args)` in `db_executor`.
+        """
+        return await db_executor.run(self._call, fn, *args)
+
+    async def load(self, pages: AsyncIterator[list[dict]]):
+        """
+        Bulk inserts pages as they arrive, within one transaction.
+        Only pages which are in flight are kept in memory, not the whole dataset.
+        """
+        await self.run(create_table, self.keys)
+        async with aclosing(pages):
+            async for page in pages:
+                await self.run(insert_rows, self.keys, page)
+        await self.run(sqlite3.Connection.commit)
+
+    def missing_columns(self, sql_query: str) -> set[str]:
+        referenced = referenced_columns(sql_query, self.schema)
+        return set(self.schema) - set(self.keys) if referenced is None else referenced - set(self.keys)
+
+    async def query(self, sql_query: str, index: bool = True) -> QueryResult:
+        """
+        :param index: build indexes the query needs, only worth it for datasets which are queried again.
+        """
+        missing = self.missing_columns(sql_query)
+        if missing:
+            raise ValueError(f"Dataset {self.dataset_id} was loaded without columns {', '.join(sorted(missing))}. "
+                             f"Run the aggregation tool again with this query.")
+        if index:
+            await self.run(create_query_indexes, self.keys, sql_query)
+        return await self.run(get_aggregate, sql_query)
+
+    def measure(self) -> int:
+        def size(conn: sqlite3.Connection) -> int:
+            conn.set_authorizer(None)  # queries set it again
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            return page_count * conn.execute("PRAGMA page_size").fetchone()[0]
+
+        self.size = self._call(size)
+        return self.size
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.conn.close()
+                self.closed = True
+
+
+class DatasetRegistry:
+    """
+    Datasets kept for follow-up queries, bounded by their total size and idle time(`ttl`).
+    Least recently used datasets are evicted first, evicted and expired ones are closed.
+    Blocking methods are meant to be run in `db_executor`.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._datasets: OrderedDict[str, Dataset] = OrderedDict()
+        self._lock = threading.Lock()
+        self._reaper: Optional[asyncio.Task] = None
+
+        self.kept = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.closed = 0
+
+    def keep(self, dataset: Dataset) -> bool:
+        """
+        Keeps a loaded dataset. Returns False if it doesn't fit into `max_bytes` at all.
+        """
+        if dataset.measure() > self.max_bytes:
+            return False
+        with self._lock:
+            self._datasets[dataset.dataset_id] = dataset
+            self.size += dataset.size
+            dataset.kept = True
+            self.kept += 1
+            evicted = []
+            while self.size > self.max_bytes:
+                evicted.append(self._pop(next(iter(self._datasets))))
+                self.evictions += 1
+        for evicted_dataset in evicted:
+            logger.debug(f"Evicted dataset: {evicted_dataset.dataset_id}")
+            evicted_dataset.close()
+        return True
+
+    def get(self, dataset_id: str) -> Dataset:
+        self.reclaim_expired()
+        with self._lock:
+            dataset = self._datasets.get(dataset_id)
+            if dataset is None:
+                raise ValueError(f"Unknown or expired dataset: {dataset_id}. Run the aggregation tool again.")
+            self._datasets.move_to_end(dataset_id)
+            return dataset
+
+    def find(self, source: Hashable, sql_query: str) -> Optional[Dataset]:
+        """
+        Dataset loaded from `source` which has all columns the query needs.
+        """
+        with self._lock:
+            return next((dataset for dataset in reversed(self._datasets.values())
+                         if dataset.source == source and not dataset.missing_columns(sql_query)), None)
+
+    def close(self, dataset_id: str) -> bool:
+        with self._lock:
+            dataset = self._pop(dataset_id) if dataset_id in self._datasets else None
+            if dataset is not None:
+                self.closed += 1
+        if dataset is None:
+            return False
+        dataset.close()
+        return True
+
+    def reclaim_expired(self):
+        expired_before = time.monotonic() - self.ttl
+        with self._lock:
+            expired = [self._pop(dataset_id) for dataset_id, dataset in list(self._datasets.items())
+                       if dataset.last_access <= expired_before]
+            self.expirations += len(expired)
+        for dataset in expired:
+            dataset.close()
+
+    def close_all(self):
+        with self._lock:
+            datasets_ = [self._pop(dataset_id) for dataset_id in list(self._datasets)]
+        for dataset in datasets_:
+            dataset.close()
+
+    def _pop(self, dataset_id: str) -> Dataset:
+        dataset = self._datasets.pop(dataset_id)
+        self.size -= dataset.size
+        return dataset
+
+    def start(self):
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def stop(self):
+        if self._reaper is None:
+            return
+        self._reaper.cancel()
+        try:
+            await self._reaper
+        except asyncio.CancelledError:
+            pass
+        self._reaper = None
+
+    async def _reap(self):
+        # datasets nobody asks for anymore are closed even if the registry isn't used
+        while True:
+            await asyncio.sleep(self.ttl / 2)
+            await db_executor.run(self.reclaim_expired)
+
+    def stats(self) -> dict:
+        return {
+            "datasets": len(self._datasets),
+            "size_bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "kept": self.kept,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "closed": self.closed,
+        }
+
+
+datasets = DatasetRegistry(config.dataset_max_bytes, config.dataset_ttl)
+# query results by dataset source and normalized query
+result_cache = LRUCache(config.result_cache_max_bytes)
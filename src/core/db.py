@@ -1,4 +1,17 @@
+import asyncio
+import functools
+import itertools
+import re
 import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from src.core.config import config
+from src.core.query import index_columns
 
 allowed_functions = {
     "json_extract", "json_each", "json_array_length", "json_type",
@@ -13,17 +26,60 @@ allowed_functions = {
 }
 
 
-def unwrap_into_table(conn: sqlite3.Connection, keys: dict, data: list[dict]):
+class DBExecutor:
+    """
+    Bounded thread pool for SQLite work, so ingestion and heavy queries don't block the event loop.
+    A connection is used by one call at a time, so it can move between worker threads.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqlite")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+
+    async def run(self, fn: Callable, *args):
+        with self._lock:
+            self.queued += 1
+
+        def call():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+        }
+
+
+db_executor = DBExecutor(config.db_workers)
+
+
+def create_table(conn: sqlite3.Connection, keys: dict):
     cols = ', '.join(f'{name} {type_}' for name, type_ in keys.items())
     conn.execute(f'DROP TABLE IF EXISTS data')
     conn.execute(f'CREATE TABLE data ({cols})')
+
+
+def insert_rows(conn: sqlite3.Connection, keys: dict, data: list[dict]):
     cols_names = ', '.join(keys)
     placeholders = ', '.join('?' for _ in keys)
     insert_sql = f'INSERT INTO data ({cols_names}) VALUES ({placeholders})'
-    for row in data:
-        values = tuple(row.get(col) for col in keys)
-        conn.execute(insert_sql, values)
-    conn.commit()
+    conn.executemany(insert_sql, (tuple(row.get(col) for col in keys) for row in data))
 
 
 def auth_cb(action, arg1, arg2, dbname, sql):
@@ -50,16 +106,111 @@ def validate_sql(conn, query):
 
 def setup_sqlite_connection() -> sqlite3.Connection:
     # concurrency?
-    conn = sqlite3.connect(":memory:")  # temp conn
+    conn = sqlite3.connect(":memory:", check_same_thread=False)  # temp conn, used from db_executor threads
     # conn.enable_load_extension(True)
     # conn.execute("SELECT load_extension('json1')")
     return conn
 
 
-def get_aggregate(conn: sqlite3.Connection, sql_query: str):
+_AUTOMATIC_INDEX_RE = re.compile(r"AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX \((.*)\)")
+
+
+def create_query_indexes(conn: sqlite3.Connection, keys: dict, sql_query: str):
+    """
+    Builds indexes on `data` which the query would otherwise do without(full scans)
+    or build temporarily(e.g. for self-joins), so that later queries reuse them as well.
+    Tables smaller than `auto_index_min_rows` are scanned fast enough and are left as they are.
+    Meant for datasets kept for follow-up queries, a single query doesn't pay off an index.
+    """
+    # the query is planned under the same restrictions it runs with
+    conn.set_authorizer(auth_cb)
+    rows_count = conn.execute("SELECT max(rowid) FROM data").fetchone()[0] or 0  # rows are never deleted
+    if rows_count < config.auto_index_min_rows:
+        return
+    try:
+        details = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql_query.strip().rstrip(';')}")]
+    except sqlite3.Error:
+        return  # the query itself reports the error
+
+    indexes = []
+    for detail in details:
+        match = _AUTOMATIC_INDEX_RE.search(detail)
+        if match:
+            indexes.append(re.findall(r"(\w+)=\?", match.group(1)))
+    if any(detail.startswith("SCAN ") for detail in details):
+        indexes.append(index_columns(sql_query, keys))
+    conn.set_authorizer(None)  # our own statements, column names come from `keys`
+    try:
+        for columns in indexes:
+            if columns and all(column in keys for column in columns):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS data_{'_'.join(columns)} ON data ({', '.join(columns)})")
+    finally:
+        conn.set_authorizer(auth_cb)
+
+
+@dataclass
+class QueryResult:
+    rows: list[tuple]
+    truncated: bool = False  # there were more rows than `query_max_rows` or `query_max_result_bytes` allow
+    aborted: Optional[str] = None  # why the query was interrupted, rows are the ones fetched before that
+    size: int = 0  # approximate size of rows in bytes
+
+    def as_dict(self) -> dict:
+        return {"result": self.rows, "truncated": self.truncated, "aborted": self.aborted}
+
+
+_PROGRESS_STEPS = 10_000  # VM instructions between progress handler calls
+_FETCH_BATCH = 256
+
+
+def _row_size(row: tuple) -> int:
+    return sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row)
+
+
+def collect_rows(result: QueryResult, rows: Iterable[tuple]) -> QueryResult:
+    """
+    Appends rows to the result until `query_max_rows` or `query_max_result_bytes`.
+    """
+    for row in rows:
+        row_size = _row_size(row)
+        if len(result.rows) >= config.query_max_rows or result.size + row_size > config.query_max_result_bytes:
+            result.truncated = True
+            break
+        result.rows.append(row)
+        result.size += row_size
+    return result
+
+
+def get_aggregate(conn: sqlite3.Connection, sql_query: str) -> QueryResult:
+    """
+    Runs the query within `query_cpu_time_limit` and `query_max_steps` budgets,
+    fetching rows incrementally until `query_max_rows` or `query_max_result_bytes`.
+    """
     # maybe transform this into usual table, so model has better performance? TODO
     conn.set_authorizer(auth_cb)
-    cur = conn.cursor()
-    cur.execute(sql_query)
-    result = cur.fetchall()
+    started_at = time.thread_time()  # CPU time, SQLite runs in this thread
+    steps = 0
+    aborted = None
+
+    def check_budget() -> int:
+        nonlocal steps, aborted
+        steps += _PROGRESS_STEPS
+        if config.query_max_steps and steps > config.query_max_steps:
+            aborted = f"query exceeded the limit of {config.query_max_steps} SQLite VM steps"
+        elif time.thread_time() - started_at > config.query_cpu_time_limit:
+            aborted = f"query exceeded the limit of {config.query_cpu_time_limit}s of CPU time"
+        return aborted is not None  # non-zero interrupts the query
+
+    result = QueryResult([])
+    conn.set_progress_handler(check_budget, _PROGRESS_STEPS)
+    try:
+        cur = conn.execute(sql_query)
+        collect_rows(result, itertools.chain.from_iterable(iter(functools.partial(cur.fetchmany, _FETCH_BATCH), [])))
+        cur.close()
+    except sqlite3.OperationalError:
+        if aborted is None:
+            raise
+        result.aborted = aborted
+    finally:
+        conn.set_progress_handler(None, 0)
     return result
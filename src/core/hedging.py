@@ -0,0 +1,99 @@
+import asyncio
+import math
+import time
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, Optional
+
+
+class RequestHedger:
+    """
+    Hedges idempotent requests against slow responses: if the first attempt hasn't answered within
+    the `percentile` of recent latencies of its endpoint, a second attempt starts.
+    The first successful response wins and the other attempt is cancelled.
+    Second attempts are capped at `max_extra_ratio` of all requests, so hedging can't spend much extra quota.
+    Attempts cancelled for a faster one are observed too, their time so far is a lower bound of their latency.
+    """
+
+    def __init__(self, enabled: bool, percentile: float, max_extra_ratio: float,
+                 min_samples: int = 20, window: int = 200, congested: Callable[[], bool] = lambda: False):
+        """
+        :param min_samples: endpoints with fewer observed latencies aren't hedged.
+        :param window: number of recent latencies kept per endpoint.
+        :param congested: tells when requests wait for their turn(e.g. rate limited), not for the API.
+            Latencies aren't observed then, and a second attempt would only wait in the same line.
+        """
+        self.enabled = enabled
+        self.congested = congested
+        self.percentile = percentile
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self._latencies: defaultdict[Hashable, deque[float]] = defaultdict(lambda: deque(maxlen=window))
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0  # second attempt answered first
+        self.over_budget = 0  # slow requests which weren't hedged because of the cap
+
+    def hedge_delay(self, endpoint: Hashable) -> Optional[float]:
+        latencies = self._latencies.get(endpoint)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(len(ordered) * self.percentile / 100) - 1)]
+
+    async def run(self, endpoint: Hashable, request_fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Runs `request_fn`, hedged with a second call of it when the first one is slow for `endpoint`.
+        """
+        if not self.enabled or self.congested():
+            return await request_fn()
+        self.requests += 1
+        attempts = {asyncio.ensure_future(self._timed(endpoint, request_fn)): False}
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.hedge_delay(endpoint))
+            if not done and not self.congested():
+                if self.hedged < self.max_extra_ratio * self.requests:
+                    self.hedged += 1
+                    attempts[asyncio.ensure_future(self._timed(endpoint, request_fn))] = True
+                else:
+                    self.over_budget += 1
+
+            pending = set(attempts)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        self.hedge_wins += attempts[attempt]
+                        return attempt.result()
+                    error = error or attempt.exception()
+            raise error  # every attempt failed
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _timed(self, endpoint: Hashable, request_fn: Callable[[], Awaitable[Any]]) -> Any:
+        congested = self.congested()
+        started_at = time.monotonic()
+        try:
+            result = await request_fn()
+        except asyncio.CancelledError:
+            self._observe(endpoint, started_at, congested)
+            raise
+        self._observe(endpoint, started_at, congested)
+        return result
+
+    def _observe(self, endpoint: Hashable, started_at: float, congested: bool):
+        if not congested and not self.congested():
+            self._latencies[endpoint].append(time.monotonic() - started_at)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "over_budget": self.over_budget,
+            "hedge_delays": {str(endpoint): self.hedge_delay(endpoint) for endpoint in self._latencies},
+        }
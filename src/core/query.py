@@ -0,0 +1,496 @@
+import logging
+import math
+import re
+from collections.abc import AsyncIterator, Hashable, Iterable
+from contextlib import aclosing
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Optional
+
+from src.core.utils import window_pages
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^']|'')*')
+        |(?P<quoted>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*])
+        |(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+)
+        |(?P<name>[A-Za-z_][A-Za-z_0-9$]*)
+        |(?P<op><=|>=|<>|!=|==|\|\||<<|>>|\S)
+    )""", re.VERBOSE)
+
+AGGREGATE_FUNCTIONS = {"count", "sum", "avg", "min", "max", "total", "group_concat"}
+CLAUSE_KEYWORDS = {"group", "order", "limit", "having", "window", "union", "intersect", "except"}
+_COMPARISON_FLIPS = {"=": "=", "==": "=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+@dataclass
+class Token:
+    kind: str  # string, name, number or op. Quoted identifiers are names.
+    value: str  # names and keywords are lowercase, strings are unquoted
+
+    def is_name(self, *values: str) -> bool:
+        return self.kind == "name" and (not values or self.value in values)
+
+    def is_op(self, *values: str) -> bool:
+        return self.kind == "op" and self.value in values
+
+
+def tokenize(sql_query: str, fold_quoted: bool = True) -> Optional[list[Token]]:
+    """
+    Splits an SQLite query into tokens. Returns None for queries it doesn't understand(e.g. with comments).
+    :param fold_quoted: lowercase quoted identifiers like other names.
+    """
+    tokens = []
+    position = 0
+    sql_query = sql_query.strip().rstrip(";")
+    while position < len(sql_query):
+        match = _TOKEN_RE.match(sql_query, position)
+        if match is None or match.end() == position:
+            break
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = value[1:-1].replace("''", "'")
+        elif kind == "quoted":
+            kind, value = "name", value[1:-1].lower() if fold_quoted else value[1:-1]
+        elif kind == "name":
+            value = value.lower()
+        elif value + sql_query[position:position + 1] in ("--", "/*"):  # comments
+            return None
+        tokens.append(Token(kind, value))
+    if position < len(sql_query.rstrip()):
+        return None
+    return tokens
+
+
+def normalize_sql(sql_query: str) -> Hashable:
+    """
+    Query without insignificant differences: whitespace, case of keywords and names, trailing `;`.
+    Quoted tokens keep their case, SQLite treats a double-quoted token which isn't a column as a string.
+    """
+    tokens = tokenize(sql_query, fold_quoted=False)
+    if tokens is None:
+        return " ".join(sql_query.split())
+    return tuple((token.kind, token.value) for token in tokens)
+
+
+def top_level(tokens: list[Token]) -> Iterable[tuple[int, Token]]:
+    """
+    Tokens outside of parentheses, with their positions.
+    """
+    depth = 0
+    for i, token in enumerate(tokens):
+        if token.is_op("("):
+            depth += 1
+        elif token.is_op(")"):
+            depth -= 1
+        elif depth == 0:
+            yield i, token
+
+
+def clause(tokens: list[Token], *keywords: str) -> Optional[list[Token]]:
+    """
+    Tokens of a top level clause starting with `keywords`(e.g. "order", "by") till the next clause.
+    """
+    start = None
+    for i, token in top_level(tokens):
+        if start is None:
+            if token.is_name(keywords[0]) and all(
+                    i + j < len(tokens) and tokens[i + j].is_name(keyword) for j, keyword in enumerate(keywords)):
+                start = i + len(keywords)
+        elif token.is_name(*CLAUSE_KEYWORDS, "where"):
+            return tokens[start:i]
+    return None if start is None else tokens[start:]
+
+
+def split_top_level(tokens: list[Token], separator: str) -> list[list[Token]]:
+    parts, current = [], []
+    positions = {i for i, token in top_level(tokens) if
+                 (token.is_name(separator) if separator.isalpha() else token.is_op(separator))}
+    for i, token in enumerate(tokens):
+        if i in positions:
+            parts.append(current)
+            current = []
+        else:
+            current.append(token)
+    parts.append(current)
+    return parts
+
+
+def _literal(tokens: list[Token]) -> Optional[Token]:
+    if len(tokens) == 1 and tokens[0].kind in ("string", "number"):
+        return tokens[0]
+    if len(tokens) == 2 and tokens[0].is_op("-") and tokens[1].kind == "number":
+        return Token("number", "-" + tokens[1].value)
+    return None
+
+
+def _column(tokens: list[Token], columns: set[str]) -> Optional[str]:
+    if len(tokens) == 3 and tokens[0].is_name("data") and tokens[1].is_op("."):
+        tokens = tokens[2:]
+    if len(tokens) == 1 and tokens[0].is_name(*columns):
+        return tokens[0].value
+    return None
+
+
+@dataclass
+class QueryPlan:
+    """
+    What part of the `data` table a query needs, so fetching can be narrowed down.
+    Bounds are loose: every row the query could use passes them.
+    Empty plan means the query needs everything.
+    """
+    # the query result stays the same if only that many first rows(in fetch order) are loaded
+    row_limit: Optional[int] = None
+    currency_ids: Optional[set[str]] = None
+    from_block: Optional[int] = None
+    to_block: Optional[int] = None
+    since: Optional[str] = None  # ISO date, inclusive
+    until: Optional[str] = None  # ISO date, exclusive
+    exact: bool = True  # bounds let through only the rows matching the query conditions
+
+    @property
+    def narrows_history(self) -> bool:
+        return self.row_limit is not None or self.from_block is not None or self.since is not None
+
+    @property
+    def filters_rows(self) -> bool:
+        return any(bound is not None for bound in
+                   (self.currency_ids, self.from_block, self.to_block, self.since, self.until))
+
+    @property
+    def loads_everything(self) -> bool:
+        return self.row_limit is None and not self.filters_rows
+
+    def page_size(self, default: int = 1000) -> int:
+        if self.row_limit is not None and not self.filters_rows:
+            return max(1, min(default, self.row_limit))
+        return default
+
+    def max_pages(self) -> Optional[int]:
+        """
+        Number of pages worth requesting, `None` if it isn't known in advance.
+        """
+        if self.row_limit is not None and not self.filters_rows:
+            return max(1, math.ceil(self.row_limit / self.page_size()))
+        return None
+
+    def narrow(self, pages: AsyncIterator[list], newest_first: bool = False) -> AsyncIterator[list]:
+        """
+        Filters fetched pages by the plan and stops fetching once enough rows are loaded.
+        :param newest_first: pages go from newest to oldest events, so block and time bounds can stop fetching.
+        """
+        if newest_first and any(bound is not None for bound in
+                                (self.from_block, self.to_block, self.since, self.until)):
+            pages = window_pages(pages, self.since, self.until, self.from_block, self.to_block)
+        if self.currency_ids is not None or self.row_limit is not None:
+            pages = self._cap(pages)
+        return pages
+
+    async def _cap(self, pages: AsyncIterator[list]) -> AsyncIterator[list]:
+        loaded = 0
+        async with aclosing(pages):
+            async for page in pages:
+                if self.currency_ids is not None:
+                    page = [row for row in page if row.get('currency_id') in self.currency_ids]
+                if self.row_limit is not None:
+                    page = page[:self.row_limit - loaded]
+                if page:
+                    loaded += len(page)
+                    yield page
+                if self.row_limit is not None and loaded >= self.row_limit:
+                    break
+
+    def _push(self, column: str, op: str, literal: Token) -> bool:
+        if column == "block" and literal.kind == "number":
+            value = float(literal.value)
+            if not math.isfinite(value):  # e.g. 1e999
+                return False
+            if not value.is_integer():
+                self.exact = False
+            elif op == ">":
+                value += 1
+            elif op == "<":
+                value -= 1
+            if op in ("=", ">", ">="):
+                self.from_block = max(self.from_block or -math.inf, math.floor(value))
+            if op in ("=", "<", "<="):
+                self.to_block = min(self.to_block if self.to_block is not None else math.inf, math.ceil(value))
+            return True
+        if column == "time" and literal.kind == "string" and re.match(r"\d{4}-\d{2}-\d{2}", literal.value):
+            # day granularity keeps the bounds loose for any format of the literal.
+            # bare date is exact: as a text it's less than any time of that day.
+            loose = len(literal.value) > 10 or op == "="
+            try:
+                day = date.fromisoformat(literal.value[:10])
+                until = (day + timedelta(days=1) if loose else day).isoformat()
+            except (ValueError, OverflowError):  # not a real date, e.g. 2024-13-01 or 9999-12-31
+                return False
+            self.exact &= not loose
+            if op in ("=", ">", ">="):
+                self.since = max(self.since or "", day.isoformat())
+            if op in ("=", "<", "<="):
+                self.until = min(self.until or until, until)
+            return True
+        if column == "currency_id" and op == "=" and literal.kind == "string":
+            self.currency_ids = {literal.value} if self.currency_ids is None else self.currency_ids & {literal.value}
+            return True
+        return False
+
+    def _push_condition(self, condition: list[Token], columns: set[str]) -> bool:
+        for i, token in enumerate(condition):
+            if token.is_name("in") and i + 1 < len(condition) and condition[i + 1].is_op("("):
+                column = _column(condition[:i], columns)
+                if column != "currency_id" or not condition[-1].is_op(")"):
+                    return False
+                literals = [_literal(part) for part in split_top_level(condition[i + 2:-1], ",")]
+                if not all(literal is not None and literal.kind == "string" for literal in literals):
+                    return False
+                values = {literal.value for literal in literals}
+                self.currency_ids = values if self.currency_ids is None else self.currency_ids & values
+                return True
+            if token.kind == "op" and token.value in _COMPARISON_FLIPS:
+                left, right = condition[:i], condition[i + 1:]
+                op = _COMPARISON_FLIPS["=" if token.value == "==" else token.value]
+                column, literal = _column(right, columns), _literal(left)
+                if column is None:  # usual order, column on the left
+                    column, literal, op = _column(left, columns), _literal(right), _COMPARISON_FLIPS[op]
+                return column is not None and literal is not None and self._push(column, op, literal)
+        return False
+
+
+def _where_conditions(where: list[Token]) -> Optional[list[list[Token]]]:
+    """
+    Top level AND-ed conditions of WHERE clause, None if they can't be told apart.
+    """
+    if any(token.is_name("or", "case") for _, token in top_level(where)):
+        return None
+    conditions = []
+    parts = split_top_level(where, "and")
+    i = 0
+    while i < len(parts):
+        part = parts[i]
+        between = [j for j, token in enumerate(part) if token.is_name("between")]
+        if between:  # `x BETWEEN a AND b` -> `x >= a`, `x <= b`
+            if i + 1 >= len(parts) or len(between) > 1 or any(token.is_name("not") for token in part):
+                return None
+            j = between[0]
+            conditions.append(part[:j] + [Token("op", ">=")] + part[j + 1:])
+            conditions.append(part[:j] + [Token("op", "<=")] + parts[i + 1])
+            i += 2
+            continue
+        conditions.append(part)
+        i += 1
+    return conditions
+
+
+def referenced_columns(sql_query: str, columns: Iterable[str]) -> Optional[set[str]]:
+    """
+    Columns of `data` the query mentions, None if it may need all of them(e.g. `SELECT *`, NATURAL JOIN).
+    Names are matched wherever they are, so aliases named like columns are counted as well.
+    """
+    tokens = tokenize(sql_query)
+    if tokens is None:
+        return None
+    columns = set(columns)
+    referenced = set()
+    for i, token in enumerate(tokens):
+        # `*` after an expression is multiplication, otherwise a wildcard(but not in `count(*)`)
+        if token.is_op("*") and i > 0 and (tokens[i - 1].is_name("select", "distinct", "all")
+                                           or tokens[i - 1].is_op(",", ".")):
+            return None
+        if token.is_name("natural"):
+            return None
+        if token.is_name(*columns):
+            referenced.add(token.value)
+    return referenced
+
+
+def prune_columns(keys: dict, sql_query: str) -> dict:
+    """
+    Columns of `keys` the query needs. A query which needs no columns(e.g. `count(*)`) keeps one narrow column.
+    """
+    referenced = referenced_columns(sql_query, keys)
+    if referenced is None:
+        return keys
+    if not referenced:
+        narrow_types = ("BOOLEAN", "TINYINT", "INT", "REAL")
+        referenced = {min(keys, key=lambda name: narrow_types.index(keys[name]) if keys[name] in narrow_types
+                          else len(narrow_types))}
+    return {name: type_ for name, type_ in keys.items() if name in referenced}
+
+
+def _compared_column(condition: list[Token], columns: set[str]) -> Optional[tuple[str, str]]:
+    """
+    Column and operator of `column <op> constant` or `column IN (...)` condition.
+    """
+    for i, token in enumerate(condition):
+        if token.is_name("in") and i + 1 < len(condition) and condition[i + 1].is_op("(") and condition[-1].is_op(")"):
+            column = _column(condition[:i], columns)
+            return None if column is None else (column, "=")
+        if token.kind == "op" and token.value in _COMPARISON_FLIPS:
+            left, right = condition[:i], condition[i + 1:]
+            op = _COMPARISON_FLIPS["=" if token.value == "==" else token.value]
+            if _column(left, columns) is not None and _literal(right) is not None:
+                return _column(left, columns), _COMPARISON_FLIPS[op]
+            if _column(right, columns) is not None and _literal(left) is not None:
+                return _column(right, columns), op
+            return None
+    return None
+
+
+def index_columns(sql_query: str, columns: Iterable[str]) -> list[str]:
+    """
+    Columns of an index which lets a select from `data` skip the full scan:
+    columns compared to constants in WHERE(equalities first, then one range), otherwise GROUP BY columns.
+    Empty if there's nothing to index.
+    """
+    tokens = tokenize(sql_query)
+    if not tokens or not tokens[0].is_name("select"):
+        return []
+    from_clause = clause(tokens, "from")
+    if from_clause is None or len(from_clause) > 2 or not from_clause[0].is_name("data"):
+        return []
+
+    columns = set(columns)
+    where = clause(tokens, "where")
+    compared = [_compared_column(condition, columns) for condition in (_where_conditions(where) or [])] \
+        if where is not None else []
+    index = [column for column, op in filter(None, compared) if op == "="]
+    ranges = [column for column, op in filter(None, compared) if op != "="]
+    if ranges:
+        index.append(ranges[0])
+    else:
+        group_by = clause(tokens, "group", "by")
+        group_columns = [_column(part, columns) for part in split_top_level(group_by or [], ",")]
+        if group_by and all(group_columns):
+            index.extend(group_columns)
+    return list(dict.fromkeys(index))
+
+
+@dataclass
+class GroupAggregate:
+    """
+    `SELECT [key,] fn(column), ... FROM data [GROUP BY key]` query.
+    Outputs are `(fn, column)` in the select order: fn is None for the group key, column is None for `count(*)`.
+    """
+    group_by: Optional[str]
+    outputs: list[tuple[Optional[str], Optional[str]]]
+
+
+GROUP_AGGREGATE_FUNCTIONS = {"count", "sum", "total", "avg", "min", "max"}
+NUMERIC_TYPES = {"REAL", "INT", "TINYINT", "BOOLEAN"}
+
+
+def match_group_aggregate(sql_query: str, keys: dict) -> Optional[GroupAggregate]:
+    """
+    Recognizes simple aggregations of numeric columns, grouped by a text column or not grouped at all.
+    None for anything else(filters, ordering, expressions, DISTINCT).
+    """
+    tokens = tokenize(sql_query)
+    if not tokens or not tokens[0].is_name("select"):
+        return None
+    from_positions = [i for i, token in top_level(tokens) if token.is_name("from")]
+    if len(from_positions) != 1 or from_positions[0] + 1 >= len(tokens):
+        return None
+    from_position = from_positions[0]
+    if not tokens[from_position + 1].is_name("data"):
+        return None
+
+    columns = set(keys)
+    group_by = None
+    rest = tokens[from_position + 2:]
+    if rest:
+        if len(rest) < 3 or not (rest[0].is_name("group") and rest[1].is_name("by")):
+            return None
+        group_by = _column(rest[2:], columns)
+        if group_by is None or keys[group_by] != "TEXT":
+            return None
+
+    outputs = []
+    for item in split_top_level(tokens[1:from_position], ","):
+        if len(item) > 2 and item[-2].is_name("as"):
+            item = item[:-2]
+        elif len(item) > 1 and item[-1].kind == "name" and (item[-2].is_op(")") or len(item) == 2):
+            item = item[:-1]  # alias without AS
+        column = _column(item, columns)
+        if column is not None and column == group_by:
+            outputs.append((None, column))
+            continue
+        if not (len(item) > 3 and item[0].is_name(*GROUP_AGGREGATE_FUNCTIONS)
+                and item[1].is_op("(") and item[-1].is_op(")")):
+            return None
+        fn, argument = item[0].value, item[2:-1]
+        if fn == "count" and len(argument) == 1 and argument[0].is_op("*"):
+            outputs.append((fn, None))
+            continue
+        column = _column(argument, columns)
+        if column is None or (fn != "count" and keys[column] not in NUMERIC_TYPES):
+            return None
+        outputs.append((fn, column))
+    if all(fn is None for fn, _ in outputs):
+        return None
+    return GroupAggregate(group_by, outputs)
+
+
+def analyze_query(sql_query: str, columns: Iterable[str], newest_first_columns: Iterable[str] = ()) -> QueryPlan:
+    """
+    Works out what part of the `data` table the query needs.
+    Queries it fails to analyze need the whole table.
+    :param columns: columns of the `data` table.
+    :param newest_first_columns: columns which descending order matches the fetch order(e.g. `block`, `time`).
+    """
+    try:
+        return _analyze_query(sql_query, columns, newest_first_columns)
+    except Exception:
+        logger.exception(f"Failed to analyze query: {sql_query}")
+        return QueryPlan()
+
+
+def _analyze_query(sql_query: str, columns: Iterable[str], newest_first_columns: Iterable[str]) -> QueryPlan:
+    plan = QueryPlan()
+    tokens = tokenize(sql_query)
+    if not tokens or not tokens[0].is_name("select"):
+        return plan
+    # a single select from `data` only, no joins or subqueries
+    if sum(token.is_name("select") for token in tokens) != 1:
+        return plan
+    from_clause = clause(tokens, "from")
+    if from_clause is None or len(from_clause) > 2 or not from_clause[0].is_name("data"):
+        return plan
+
+    columns = set(columns)
+    where = clause(tokens, "where")
+    all_pushed = True
+    if where is not None:
+        conditions = _where_conditions(where)
+        if conditions is None:
+            return QueryPlan()
+        for condition in conditions:
+            all_pushed &= plan._push_condition(condition, columns)
+
+    limit = clause(tokens, "limit")
+    if limit is None or not all_pushed or not plan.exact:
+        return plan
+    select_list = tokens[1:next(i for i, token in top_level(tokens) if token.is_name("from"))]
+    aggregated = any(
+        token.is_name(*AGGREGATE_FUNCTIONS) and i + 1 < len(tokens) and tokens[i + 1].is_op("(")
+        for i, token in enumerate(tokens)
+    ) or any(token.is_name("distinct", "over") for token in select_list)
+    if aggregated or clause(tokens, "group", "by") is not None or clause(tokens, "having") is not None:
+        return plan
+
+    order_by = clause(tokens, "order", "by")
+    if order_by is not None and not (
+            len(order_by) == 2 and _column(order_by[:1], set(newest_first_columns)) and order_by[1].is_name("desc")):
+        return plan
+
+    # LIMIT n | LIMIT n OFFSET m | LIMIT m, n
+    numbers = [token for token in limit if not token.is_name("offset") and not token.is_op(",")]
+    if not all(token.kind == "number" and token.value.isdigit() for token in numbers) or len(numbers) > 2:
+        return plan
+    plan.row_limit = sum(int(token.value) for token in numbers)
+    return plan
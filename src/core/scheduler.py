@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections.abc import Awaitable, Callable
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, Optional
+
+from src.core.config import config
+
+
+class Priority(IntEnum):
+    interactive = 0
+    bulk = 1  # pagination and fan-outs of aggregations
+
+
+# priority of API requests made in the current context
+request_priority: ContextVar[Priority] = ContextVar("request_priority", default=Priority.interactive)
+
+
+def prioritized(async_fetcher: Callable[..., Awaitable[Any]], priority: Priority) -> Callable[..., Awaitable[Any]]:
+    """
+    Wraps a fetcher so API requests it makes are scheduled with `priority`.
+    """
+
+    async def fetch(*args, **kwargs):
+        token = request_priority.set(priority)
+        try:
+            return await async_fetcher(*args, **kwargs)
+        finally:
+            request_priority.reset(token)
+
+    return fetch
+
+
+class RequestScheduler:
+    """
+    Token bucket pacing API requests to `rate` per second, with bursts of up to `burst` requests.
+    Waiting requests get tokens by priority and then in order of arrival,
+    so interactive calls overtake bulk pagination queued before them.
+    After a 429 response nobody gets a token until the API allows requests again.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """
+        :param rate: requests per second, 0 is unlimited.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+        self.granted = 0
+        self.delayed = 0
+        self.throttled = 0
+
+    async def acquire(self, priority: Priority = Priority.interactive):
+        if self.rate <= 0:
+            return
+        self._refill()
+        if not self.queue_depth and self._take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        self.delayed += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():  # the token was granted already, someone else takes it
+                self._tokens += 1
+                self._dispatch()
+            future.cancel()
+            raise
+
+    def throttle(self, delay: float):
+        """
+        Holds back all requests for `delay` seconds, e.g. after `Retry-After`.
+        """
+        self.throttled += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self._tokens = min(self._tokens, 1)  # one request probes the API once the pause is over
+
+    def _refill(self):
+        now = time.monotonic()
+        if now >= self._paused_until:
+            elapsed = now - max(self._refilled_at, self._paused_until)
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._refilled_at = now
+
+    def _take(self) -> bool:
+        if self._tokens < 1 or time.monotonic() < self._paused_until:
+            return False
+        self._tokens -= 1
+        self.granted += 1
+        return True
+
+    def _dispatch(self):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        self._refill()
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():  # cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            if not self._take():
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+        if self._waiters:
+            delay = max(self._paused_until - time.monotonic(), (1 - self._tokens) / self.rate, 0)
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    @property
+    def congested(self) -> bool:
+        """
+        Requests wait for their turn: the API asked to slow down or tokens ran out.
+        """
+        return self.rate > 0 and (time.monotonic() < self._paused_until or self.queue_depth > 0)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(not future.done() for _, _, future in self._waiters)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "queued_by_priority": {
+                priority.name: sum(not future.done() for waiter_priority, _, future in self._waiters
+                                   if waiter_priority == priority)
+                for priority in Priority
+            },
+            "rate": self.rate,
+            "burst": self.burst,
+            "granted": self.granted,
+            "delayed": self.delayed,
+            "throttled": self.throttled,
+        }
+
+
+request_scheduler = RequestScheduler(config.api_requests_per_second, config.api_burst)
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from src.core.config import config
+from src.core.connector import fetch_stats
+
+logger = logging.getLogger(__name__)
+
+
+class StatsSnapshot:
+    """
+    In-memory snapshot of `fetch_stats()` for all blockchains, polled in background.
+    Reads are served from memory unless the snapshot is older than `max_staleness`
+    or a refresh is forced.
+    """
+
+    def __init__(self, refresh_interval: float, max_staleness: float):
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self._stats: Optional[dict] = None
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+        self._poller: Optional[asyncio.Task] = None
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self._fetched_at
+
+    async def refresh(self) -> dict:
+        requested_at = time.monotonic()
+        async with self._lock:
+            # someone else has refreshed while we were waiting for the lock
+            if self._fetched_at >= requested_at:
+                return self._stats
+            stats = await fetch_stats()
+            self._stats = stats
+            self._fetched_at = time.monotonic()
+            return stats
+
+    async def get(self, force_refresh: bool = False) -> dict:
+        if force_refresh or self._stats is None or self.age > self.max_staleness:
+            return await self.refresh()
+        return self._stats
+
+    async def blockchain_stats(self, blockchain: str, force_refresh: bool = False) -> dict:
+        """
+        :param force_refresh: fetch stats of this blockchain only, cheaper than refreshing all of them.
+        """
+        if force_refresh:
+            return await self.refresh_blockchain(blockchain)
+        stats = await self.get()
+        return stats['data']['blockchains'][blockchain]
+
+    async def refresh_blockchain(self, blockchain: str) -> dict:
+        stats = (await fetch_stats(blockchain))['data']['blockchains'][blockchain]
+        if self._stats is not None:
+            self._stats['data']['blockchains'][blockchain] = stats
+        return stats
+
+    async def modules(self, blockchain: str) -> list[str]:
+        blockchains = (await self.get())['library']['blockchains']
+        if blockchain not in blockchains:
+            raise ValueError(f"Unknown blockchain: {blockchain}. See `list_blockchains_and_modules`.")
+        return list(blockchains[blockchain]['modules'])
+
+    async def best_block(self, blockchain: str, at_least: Optional[int] = None, force_refresh: bool = False) -> int:
+        """
+        :param at_least: height that is known to exist, refreshes the blockchain if the snapshot is behind it.
+        """
+        best_block = (await self.blockchain_stats(blockchain, force_refresh))['best_block']
+        if not force_refresh and at_least is not None and best_block < at_least:
+            best_block = (await self.blockchain_stats(blockchain, force_refresh=True))['best_block']
+        return best_block
+
+    def start(self):
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._poller is None:
+            return
+        self._poller.cancel()
+        try:
+            await self._poller
+        except asyncio.CancelledError:
+            pass
+        self._poller = None
+
+    async def _poll(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:  # keep polling, stale reads will refresh by themselves
+                logger.warning(f"Failed to refresh stats snapshot: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+
+stats_snapshot = StatsSnapshot(config.stats_refresh_interval, config.stats_max_staleness)
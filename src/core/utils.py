@@ -1,8 +1,14 @@
-from collections import defaultdict
-from datetime import datetime
+import asyncio
+import math
+from collections import defaultdict, deque
+from collections.abc import AsyncIterator, Callable, Iterable
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal, getcontext
+from typing import Any, Optional
 
 from src.core.config import config
+from src.core.scheduler import Priority, prioritized, request_priority
 
 getcontext().prec = 30
 
@@ -27,74 +33,281 @@ def reformat_time(time_string: str) -> str:
     return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-async def collect_all_pages(async_fetcher, data_keys: list[str], get_currency_info: bool,
-                            stop_after_first: bool) -> list:
-    all_pages = []
-    current_page = 0
-    while True:
-        data = await async_fetcher(page=current_page)
+def parse_utc(value: str) -> datetime:
+    """
+    Parses ISO date or datetime into naive UTC datetime, times with an offset are converted to UTC.
+    """
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_time_bound(value: str) -> str:
+    """
+    Converts ISO date or datetime into the form comparable with event times: `YYYY-MM-DDTHH:MM:SS`.
+    """
+    return parse_utc(value).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def month_segments(since: str, until: Optional[str] = None) -> list[str]:
+    """
+    Address segments covering the time range(`until` exclusive), newest first as events in pages.
+    3xpl splits address events in segments by calendar months: `YYYY-MM`.
+    """
+    since = parse_utc(since)
+    until = parse_utc(until) if until is not None else datetime.now(timezone.utc).replace(tzinfo=None)
+    if until == datetime(until.year, until.month, 1):  # nothing of the month is in the range
+        until -= timedelta(microseconds=1)
+    segments = []
+    year, month = since.year, since.month
+    while (year, month) <= (until.year, until.month):
+        segments.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return segments[::-1]
 
-        required_data = data
-        for key in data_keys:
-            required_data = required_data[key]
-            if not required_data:
-                break
 
+def page_events(data, data_keys: list[str]):
+    required_data = data
+    for key in data_keys:
+        required_data = required_data[key]
         if not required_data:
             break
+    return required_data
+
+
+def unwrap_page(data, data_keys: list[str], get_currency_info: bool) -> list:
+    required_data = page_events(data, data_keys)
+    if not required_data:
+        return []
+    # payloads can be shared through the response cache, so rows are enriched on copies.
+    required_data = [dict(data_chunk) for data_chunk in required_data]
+
+    if get_currency_info:
+        currency_library = data['library']['currencies']
+        rates_library = data['library']['rates']
+
+        currency_timestamp_rates = defaultdict(dict)  # {ethereum: {now: 123123, 2077-12-12: 12314123}}
+        for timestamp, currencies_rates in rates_library.items():
+            for currency, rate_info in currencies_rates.items():
+                # fiat_ticker = list(rate_info.keys())[0]
+                currency_timestamp_rates[currency].update({timestamp: rate_info})
+
+        for data_chunk in required_data:
+            currency_id = data_chunk['currency']
+
+            data_chunk['currency_id'] = currency_id
+            data_chunk['currency_symbol'] = currency_library[currency_id]['symbol']
+            data_chunk['currency_decimals'] = currency_library[currency_id]['decimals']
+
+            # different processing of rates depending on the endpoint:
+            #  - blocks - get from first date, no dates in events.
+            #  - balances - get from `now`, no dates in events.
+            #  - address transactions/mempool - get from rates from according timestamp from event itself.
+            if currency_timestamp_rates[currency_id]:
+                data_chunk['currency_verified'] = True
 
-        if get_currency_info:
-            currency_library = data['library']['currencies']
-            rates_library = data['library']['rates']
-
-            currency_timestamp_rates = defaultdict(dict)  # {ethereum: {now: 123123, 2077-12-12: 12314123}}
-            for timestamp, currencies_rates in rates_library.items():
-                for currency, rate_info in currencies_rates.items():
-                    # fiat_ticker = list(rate_info.keys())[0]
-                    currency_timestamp_rates[currency].update({timestamp: rate_info})
-
-            for data_chunk in required_data:
-                currency_id = data_chunk['currency']
-
-                data_chunk['currency_symbol'] = currency_library[currency_id]['symbol']
-                data_chunk['currency_decimals'] = currency_library[currency_id]['decimals']
-
-                # different processing of rates depending on the endpoint:
-                #  - blocks - get from first date, no dates in events.
-                #  - balances - get from `now`, no dates in events.
-                #  - address transactions/mempool - get from rates from according timestamp from event itself.
-                if currency_timestamp_rates[currency_id]:
-                    data_chunk['currency_verified'] = True
-
-                    if data_chunk.get('time'):  # or not data_chunk.get('block'):
-                        data_chunk['exchange_rate'] = currency_timestamp_rates[currency_id][data_chunk['time']]['usd']
-                    elif not data_chunk.get('block'):
-                        if data['data'].get('block'):
-                            timestamp = data['data']['block']['time']
-                        elif data['data'].get('transaction'):
-                            timestamp = data['data']['transaction']['time']
-                        else:
-                            raise ValueError()
-                        data_chunk['exchange_rate'] = \
-                            currency_timestamp_rates[currency_id][timestamp]['usd']
+                if data_chunk.get('time'):  # or not data_chunk.get('block'):
+                    data_chunk['exchange_rate'] = currency_timestamp_rates[currency_id][data_chunk['time']]['usd']
+                elif not data_chunk.get('block'):
+                    if data['data'].get('block'):
+                        timestamp = data['data']['block']['time']
+                    elif data['data'].get('transaction'):
+                        timestamp = data['data']['transaction']['time']
                     else:
-                        data_chunk['exchange_rate'] = currency_timestamp_rates[currency_id]['now']['usd']
+                        raise ValueError()
+                    data_chunk['exchange_rate'] = \
+                        currency_timestamp_rates[currency_id][timestamp]['usd']
                 else:
-                    data_chunk['currency_verified'] = False
+                    data_chunk['exchange_rate'] = currency_timestamp_rates[currency_id]['now']['usd']
+            else:
+                data_chunk['currency_verified'] = False
 
-        for data_chunk in required_data:
-            if "transaction" not in data_chunk:
+    for data_chunk in required_data:
+        if "transaction" not in data_chunk:
+            break
+        data_chunk['transaction_hash'] = data_chunk['transaction']
+        del data_chunk['transaction']
+
+    return required_data
+
+
+async def prefetch_pages(async_fetcher, pages: Iterable[int], window: int, ramp_up: bool = False,
+                         is_last: Callable[[Any], bool] = lambda data: False) -> AsyncIterator:
+    """
+    Yields fetched pages in order, keeping up to `window` page requests in flight.
+    With `window` 0 the next page is requested only after the previous one was consumed.
+    Requests still in flight are cancelled once the consumer stops iterating.
+    :param ramp_up: the window starts at one request and doubles with each fetched page,
+        so streams which end soon don't request many pages past their end.
+    :param is_last: tells a fetched page is the last one, no more pages are requested after it.
+    """
+    pages = iter(pages)
+    in_flight = deque()
+    current_window = 1 if ramp_up else max(window, 1)
+
+    def schedule_next() -> bool:
+        page = next(pages, None)
+        if page is None:
+            return False
+        in_flight.append(asyncio.ensure_future(async_fetcher(page=page)))
+        return True
+
+    try:
+        while len(in_flight) < current_window and schedule_next():
+            pass
+        while in_flight:
+            data = await in_flight.popleft()
+            if is_last(data):
+                yield data
+                return
+            if window > 0:
+                current_window = min(window, current_window * 2) if ramp_up else current_window
+                while len(in_flight) < current_window and schedule_next():
+                    pass
+            yield data
+            if window <= 0:
+                schedule_next()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def iter_pages(async_fetcher, data_keys: list[str], get_currency_info: bool, stop_after_first: bool,
+                     count_keys: Optional[list[str]] = None, page_size: Optional[int] = 1000,
+                     concurrency: Optional[int] = None, max_pages: Optional[int] = None,
+                     unwrap: bool = True) -> AsyncIterator:
+    """
+    Yields unwrapped pages until the first empty or short one, `max_pages` or `pagination_limit`.
+    The first page is fetched alone, most entities fit in it.
+    If `count_keys` points to the total events count in the first page (e.g. `data.block.events.<module>`),
+    exact set of the remaining pages is planned and requested in parallel.
+    Otherwise, after a full first page the rest is prefetched with a window growing up
+    to `concurrency`(`pagination_concurrency` by default).
+    :param page_size: rows the API puts in a full page, `None` when it doesn't honour the limit(e.g. balances):
+        then pages are requested one by one until an empty one.
+    With `unwrap` off, fetched payloads are yielded as they are, to be unwrapped elsewhere.
+    """
+
+    def process(data):
+        if unwrap:
+            return unwrap_page(data, data_keys, get_currency_info)
+        return data if page_events(data, data_keys) else None
+
+    def is_last(data) -> bool:
+        rows = page_events(data, data_keys)
+        return not rows or (page_size is not None and len(rows) < page_size)
+
+    if concurrency is None:
+        concurrency = config.pagination_concurrency
+    last_page = 0 if stop_after_first else config.pagination_limit + 1
+    if max_pages is not None:
+        last_page = min(last_page, max_pages - 1)
+
+    first_page_data = await async_fetcher(page=0)
+    first_page = process(first_page_data)
+    if not first_page:
+        return
+    yield first_page
+    if is_last(first_page_data):
+        return
+
+    if count_keys is not None:
+        events_count = first_page_data
+        for key in count_keys:
+            events_count = events_count.get(key) if isinstance(events_count, dict) else None
+        if isinstance(events_count, int):
+            last_page = min(last_page, math.ceil(events_count / (page_size or 1000)) - 1)
+    if page_size is None:
+        concurrency = 0
+
+    # the first page answers the caller at its priority, the rest is bulk pagination
+    bulk_fetcher = prioritized(async_fetcher, Priority.bulk)
+    # without the count it isn't known how many pages there are
+    async with aclosing(prefetch_pages(bulk_fetcher, range(1, last_page + 1), concurrency,
+                                       ramp_up=count_keys is None, is_last=is_last)) as pages:
+        async for data in pages:
+            page = process(data)
+            if not page:
+                break
+            yield page
+            if is_last(data):  # pages prefetched before it turned out the last are cancelled
                 break
-            data_chunk['transaction_hash'] = data_chunk['transaction']
-            del data_chunk['transaction']
 
-        all_pages.extend(required_data)
 
-        if stop_after_first or current_page > config.pagination_limit:
-            break
+async def window_pages(pages: AsyncIterator[list], since: Optional[str] = None, until: Optional[str] = None,
+                       from_block: Optional[int] = None, to_block: Optional[int] = None) -> AsyncIterator[list]:
+    """
+    Keeps only events within the time(`since` inclusive, `until` exclusive) and block(inclusive) windows.
+    Pages go from newest to oldest events, so iteration stops once a page reaches past the window start.
+    """
+    since = None if since is None else parse_time_bound(since)
+    until = None if until is None else parse_time_bound(until)
+
+    def in_window(event: dict) -> bool:
+        return ((since is None or event['time'][:19] >= since)
+                and (until is None or event['time'][:19] < until)
+                and (from_block is None or event['block'] >= from_block)
+                and (to_block is None or event['block'] <= to_block))
+
+    async with aclosing(pages):
+        async for page in pages:
+            window_page = [event for event in page if in_window(event)]
+            if window_page:
+                yield window_page
+            oldest_event = page[-1]
+            if ((since is not None and oldest_event['time'][:19] < since)
+                    or (from_block is not None and oldest_event['block'] < from_block)):
+                break
+
+
+async def tag_pages(pages: AsyncIterator[list], **columns) -> AsyncIterator[list]:
+    """
+    Sets `columns` of every row, e.g. to tell apart rows of several sources loaded into one table.
+    """
+    async with aclosing(pages):
+        async for page in pages:
+            for row in page:
+                row.update(columns)
+            yield page
+
+
+async def merge_page_streams(streams: Iterable[AsyncIterator[list]], concurrency: int) -> AsyncIterator[list]:
+    """
+    Drains several page streams concurrently, at most `concurrency` of them at once,
+    and yields pages in the order they arrive.
+    """
+    streams = list(streams)
+    queue = asyncio.Queue(maxsize=max(concurrency, 1))
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    streams_done = object()
+
+    async def drain(stream: AsyncIterator[list]):
+        request_priority.set(Priority.bulk)  # the task has its own context
+        async with semaphore:
+            async with aclosing(stream):
+                async for page in stream:
+                    await queue.put(page)
+
+    tasks = [asyncio.ensure_future(drain(stream)) for stream in streams]
+
+    async def supervise():
+        try:
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(streams_done)
 
-        current_page += 1
-    return all_pages
+    supervisor = asyncio.ensure_future(supervise())
+    try:
+        while (item := await queue.get()) is not streams_done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        for task in [*tasks, supervisor]:
+            task.cancel()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from collections.abc import Collection
+from contextlib import aclosing
+from pathlib import Path
+from typing import Optional
+
+from src.core.config import config
+from src.core.db import db_executor
+from src.core.stats import stats_snapshot
+from src.core.utils import iter_pages
+
+logger = logging.getLogger(__name__)
+
+# columns of address transfers `data` table.
+# made number real, so LLM can operate on it without casting.
+# but it has a downside of decreased accuracy.
+EVENT_COLUMNS = {
+    "block": "INT", "transaction_hash": "TEXT", "time": "TEXT", "currency_id": "TEXT",
+    "effect": "REAL", "failed": "BOOLEAN", "extra": "TEXT", "currency_symbol": "TEXT",
+    "currency_verified": "BOOLEAN", "currency_decimals": "TINYINT", "exchange_rate": "REAL",
+}
+
+# columns of `data` telling apart events of several owners, filled from the warehouse columns
+OWNER_COLUMNS = {"module": "module", "owner_address": "address"}
+
+
+class EventWarehouse:
+    """
+    On-disk SQLite store of confirmed address events, keyed by blockchain, module and address.
+    Each address remembers the newest synced block, so later syncs fetch only pages newer than that.
+    Stored events of an address have no gaps: they go from the newest synced block down to the first event,
+    or down to where the pagination limit cut the history(the address is marked as `truncated` then).
+    When the store outgrows `max_bytes`, the least recently accessed addresses are evicted.
+    Blocking methods are meant to be run in `db_executor`.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_lock = threading.RLock()  # connection is shared by db_executor threads
+        # locks of addresses being synced, dropped once nobody holds or waits for them
+        self._address_locks: dict[tuple, asyncio.Lock] = {}
+        self._address_lock_users: Counter[tuple] = Counter()
+        self._syncing: frozenset[tuple] = frozenset()  # read by db_executor threads, so replaced and not mutated
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            cols = ', '.join(f'{name} {type_}' for name, type_ in EVENT_COLUMNS.items())
+            conn.execute(f"CREATE TABLE IF NOT EXISTS events (blockchain TEXT, module TEXT, address TEXT, {cols})")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_owner ON events (blockchain, module, address, block)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS synced_addresses (
+                    blockchain TEXT, module TEXT, address TEXT,
+                    newest_block INT, last_access REAL, truncated BOOLEAN NOT NULL DEFAULT 0,
+                    PRIMARY KEY (blockchain, module, address)
+                )""")
+            if "truncated" not in {row[1] for row in conn.execute("PRAGMA table_info(synced_addresses)")}:
+                conn.execute("ALTER TABLE synced_addresses ADD COLUMN truncated BOOLEAN NOT NULL DEFAULT 0")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def newest_block(self, blockchain: str, module: str, address: str) -> Optional[int]:
+        synced = self._synced_range((blockchain, module, address))
+        return None if synced is None else synced[0]
+
+    def _synced_range(self, owner: tuple) -> Optional[tuple[int, bool]]:
+        with self._conn_lock:
+            row = self.conn.execute(
+                "SELECT newest_block, truncated FROM synced_addresses WHERE blockchain = ? AND module = ? AND address = ?",
+                owner
+            ).fetchone()
+        return None if row is None else (row[0], bool(row[1]))
+
+    async def sync_address(self, blockchain: str, module: str, address: str, async_fetcher):
+        """
+        Fetches events newer than the newest synced block and stores them.
+        Pages are committed one by one, address is marked as synced only when the whole sync succeeds.
+        When the pagination limit stops a sync before the previously synced events, older events are dropped,
+        so the stored history has no gap. Events of blocks which can still be reorganized are stored,
+        but the address is marked as synced below them, so the next sync fetches them again.
+        """
+        owner = (blockchain, module, address)
+        lock = self._address_locks.setdefault(owner, asyncio.Lock())
+        self._address_lock_users[owner] += 1
+        self._syncing = frozenset(self._address_locks)
+        try:
+            async with lock:
+                await self._sync_address(owner, async_fetcher)
+        finally:
+            self._address_lock_users[owner] -= 1
+            if not self._address_lock_users[owner]:
+                del self._address_lock_users[owner], self._address_locks[owner]
+                self._syncing = frozenset(self._address_locks)
+
+    async def _sync_address(self, owner: tuple, async_fetcher):
+        blockchain, module, _ = owner
+        final_block = await stats_snapshot.best_block(blockchain) - config.finality_confirmations
+        newest_block, truncated = await db_executor.run(self._synced_range, owner) or (None, False)
+        # leftovers of a sync that didn't finish
+        await db_executor.run(self._delete_events_after, owner, -1 if newest_block is None else newest_block)
+
+        synced_block = newest_block
+        reached_synced = False
+        pages_count = 0
+        max_pages = config.pagination_limit + 2  # as many as `iter_pages` fetches at most
+        pages = iter_pages(
+            async_fetcher, ["data", "events", module], get_currency_info=True, stop_after_first=False,
+            # known address usually has only a few new events, so not prefetching pages ahead
+            concurrency=None if newest_block is None else 0, max_pages=max_pages,
+        )
+        async with aclosing(pages):
+            async for page in pages:
+                pages_count += 1
+                new_events = page if newest_block is None else [
+                    event for event in page if event['block'] > newest_block
+                ]
+                await db_executor.run(self._insert_events, owner, new_events)
+                final_events = [event['block'] for event in new_events if event['block'] <= final_block]
+                if final_events:
+                    synced_block = max(synced_block or -1, max(final_events))
+                if len(new_events) < len(page):  # reached already synced events
+                    reached_synced = True
+                    break
+
+        if not reached_synced and pages_count == max_pages:  # history was cut by the pagination limit
+            truncated = True
+            if newest_block is not None:
+                # events between the fetched pages and the previous sync are missing
+                await db_executor.run(self._delete_events_before, owner, newest_block)
+        await db_executor.run(self._mark_synced, owner, -1 if synced_block is None else synced_block, truncated)
+
+    def _delete_events_after(self, owner: tuple, block: int):
+        with self._conn_lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM events WHERE blockchain = ? AND module = ? AND address = ? AND block > ?",
+                (*owner, block)
+            )
+
+    def _insert_events(self, owner: tuple, events: list[dict]):
+        cols_names = ', '.join(EVENT_COLUMNS)
+        placeholders = ', '.join('?' for _ in range(len(EVENT_COLUMNS) + 3))
+        with self._conn_lock, self.conn:
+            self.conn.executemany(
+                f"INSERT INTO events (blockchain, module, address, {cols_names}) VALUES ({placeholders})",
+                ((*owner, *(event.get(col) for col in EVENT_COLUMNS)) for event in events)
+            )
+
+    def _delete_events_before(self, owner: tuple, block: int):
+        """
+        Deletes events in `block` and older ones.
+        """
+        with self._conn_lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM events WHERE blockchain = ? AND module = ? AND address = ? AND block <= ?",
+                (*owner, block)
+            )
+
+    def _mark_synced(self, owner: tuple, newest_block: int, truncated: bool):
+        with self._conn_lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO synced_addresses (blockchain, module, address, newest_block, last_access, "
+                "truncated) VALUES (?, ?, ?, ?, ?, ?)",
+                (*owner, newest_block, time.time(), truncated)
+            )
+
+    def load_into(self, conn: sqlite3.Connection, keys: dict, blockchain: str, *owners: tuple[str, str]):
+        """
+        Copies synced events of (module, address) owners into `data` table of `conn`, newest first.
+        `keys` can have `OWNER_COLUMNS` to tell the owners apart.
+        Then the store is trimmed to `max_bytes`, evicting other addresses first.
+        """
+        data_columns = list(keys)
+        event_columns = [OWNER_COLUMNS.get(name, name) for name in keys]
+        placeholders = ', '.join('(?, ?)' for _ in owners)
+        conn.execute(f"DROP TABLE IF EXISTS data")
+        conn.execute(f"CREATE TABLE data ({', '.join(f'{name} {type_}' for name, type_ in keys.items())})")
+        conn.execute("ATTACH DATABASE ? AS warehouse", (str(self.path),))
+        try:
+            conn.execute(
+                f"INSERT INTO data ({', '.join(data_columns)}) SELECT {', '.join(event_columns)} FROM warehouse.events "
+                f"WHERE blockchain = ? AND (module, address) IN (VALUES {placeholders}) ORDER BY block DESC, rowid",
+                (blockchain, *(value for owner in owners for value in owner))
+            )
+            conn.commit()
+        finally:
+            conn.execute("DETACH DATABASE warehouse")
+        with self._conn_lock, self.conn:
+            self.conn.executemany(
+                "UPDATE synced_addresses SET last_access = ? WHERE blockchain = ? AND module = ? AND address = ?",
+                ((time.time(), blockchain, *owner) for owner in owners)
+            )
+            self._evict_cold_addresses({(blockchain, *owner) for owner in owners})
+
+    def size(self) -> int:
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def _evict_cold_addresses(self, keep: Collection[tuple]):
+        """
+        Evicts the least recently accessed owners until the store fits `max_bytes`.
+        :param keep: (blockchain, module, address) owners which aren't evicted, e.g. a batch being loaded.
+        """
+        keep = {*keep, *self._syncing}  # evicting events of a sync in progress would leave a gap
+        while self.size() > self.max_bytes:
+            # events of a sync that didn't finish have no synced address yet, they go first
+            coldest = self.conn.execute(
+                "SELECT blockchain, module, address FROM (SELECT DISTINCT blockchain, module, address FROM events) "
+                "LEFT JOIN synced_addresses USING (blockchain, module, address) "
+                "ORDER BY coalesce(last_access, 0) LIMIT ?",
+                (len(keep) + 1,)
+            ).fetchall()
+            coldest = [owner for owner in coldest if owner not in keep]
+            if not coldest:
+                break
+            logger.debug(f"Evicting address from warehouse: {coldest[0]}")
+            with self.conn:
+                for table in ("events", "synced_addresses"):
+                    self.conn.execute(
+                        f"DELETE FROM {table} WHERE blockchain = ? AND module = ? AND address = ?", coldest[0]
+                    )
+
+
+event_warehouse = EventWarehouse(config.warehouse_path, config.warehouse_max_bytes)
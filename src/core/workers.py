@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from src.core.config import config
+from src.core.db import setup_sqlite_connection, create_table, insert_rows, get_aggregate, QueryResult
+from src.core.utils import unwrap_page
+
+logger = logging.getLogger(__name__)
+
+
+def aggregate_pages(pages: list, data_keys: list[str], get_currency_info: bool, keys: dict,
+                    sql_query: str) -> QueryResult:
+    """
+    Runs in a worker process: unwraps fetched pages, loads them into a `data` table and runs the query.
+    """
+    conn = setup_sqlite_connection()
+    try:
+        create_table(conn, keys)
+        for data in pages:
+            insert_rows(conn, keys, unwrap_page(data, data_keys, get_currency_info))
+        conn.commit()
+        return get_aggregate(conn, sql_query)
+    finally:
+        conn.close()
+
+
+class AggregationPool:
+    """
+    Optional process pool, so unwrapping pages, loading and querying them use more than one core.
+    Only result rows come back from workers. Workers are replaced after `max_tasks_per_worker` calls.
+    Disabled with 0 workers.
+    """
+
+    def __init__(self, workers: int, max_tasks_per_worker: Optional[int]):
+        self.workers = workers
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.submitted = 0
+        self.completed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 max_tasks_per_child=self.max_tasks_per_worker or None)
+        return self._executor
+
+    async def aggregate(self, pages: list, data_keys: list[str], get_currency_info: bool, keys: dict,
+                        sql_query: str) -> QueryResult:
+        self.submitted += 1
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, aggregate_pages, pages, data_keys, get_currency_info, keys, sql_query
+            )
+        except BrokenProcessPool:
+            # a worker died(e.g. OOM), remaining workers are stopped and next call starts a new pool
+            if self._executor is executor:
+                logger.warning("Aggregation process pool is broken, restarting it")
+                self._executor = None
+                # waits for the pool's own cleanup, which is quick once it's broken, but not in the event loop
+                await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+            raise
+        finally:
+            self.completed += 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_progress": self.submitted - self.completed,
+            "completed": self.completed,
+        }
+
+
+aggregation_pool = AggregationPool(config.aggregation_workers, config.aggregation_worker_max_tasks)
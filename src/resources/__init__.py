@@ -1,3 +1,80 @@
 """
 Module for MCP resources.
 """
+from mcp.server import FastMCP
+
+from src.core.client import client
+from src.core.connector import response_cache, in_flight_requests, request_hedger
+from src.core.datasets import datasets, result_cache
+from src.core.db import db_executor
+from src.core.scheduler import request_scheduler
+from src.core.workers import aggregation_pool
+
+
+def init_resources(mcp_server: FastMCP):
+    mcp_server.resource("stats://cache")(get_cache_stats)
+    mcp_server.resource("stats://requests")(get_requests_stats)
+    mcp_server.resource("stats://scheduler")(get_scheduler_stats)
+    mcp_server.resource("stats://hedging")(get_hedging_stats)
+    mcp_server.resource("stats://db")(get_db_stats)
+    mcp_server.resource("stats://workers")(get_workers_stats)
+    mcp_server.resource("stats://datasets")(get_datasets_stats)
+    mcp_server.resource("stats://results")(get_results_stats)
+
+
+def get_cache_stats() -> dict:
+    """
+    Counters of the API response cache: entries, size, hits, misses, evictions and expirations.
+    """
+    return response_cache.stats()
+
+
+def get_requests_stats() -> dict:
+    """
+    Counters of API requests: currently in flight and coalesced into identical in-flight ones,
+    HTTP version and bytes downloaded(compressed) and decoded.
+    """
+    return {**in_flight_requests.stats(), **client.stats()}
+
+
+def get_scheduler_stats() -> dict:
+    """
+    API request pacing: requests waiting for a token(by priority), granted, delayed and throttled by 429 responses.
+    """
+    return request_scheduler.stats()
+
+
+def get_hedging_stats() -> dict:
+    """
+    Request hedging: requests, hedged ones, how often the second attempt won, slow requests left unhedged
+    because of the extra quota cap, and current hedge delays per endpoint.
+    """
+    return request_hedger.stats()
+
+
+def get_db_stats() -> dict:
+    """
+    Load of the SQLite worker threads: number of workers, queued, running and completed calls.
+    """
+    return db_executor.stats()
+
+
+def get_workers_stats() -> dict:
+    """
+    Load of the aggregation worker processes: number of workers, calls in progress and completed.
+    """
+    return aggregation_pool.stats()
+
+
+def get_datasets_stats() -> dict:
+    """
+    Datasets kept for follow-up queries: number, total size, kept, evicted, expired and closed ones.
+    """
+    return datasets.stats()
+
+
+def get_results_stats() -> dict:
+    """
+    Counters of the query result cache: entries, size, hits, misses, evictions and expirations.
+    """
+    return result_cache.stats()
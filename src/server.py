@@ -1,8 +1,32 @@
+from contextlib import asynccontextmanager
+
 from mcp.server import FastMCP
 
+from src.core.client import client
+from src.core.datasets import datasets
+from src.core.stats import stats_snapshot
+from src.core.workers import aggregation_pool
 from src.prompts import init_prompts
+from src.resources import init_resources
 from src.tools import init_tools
 
-server = FastMCP("3xpl_API")
+
+@asynccontextmanager
+async def lifespan(_: FastMCP):
+    await client.preconnect()
+    stats_snapshot.start()
+    datasets.start()
+    try:
+        yield
+    finally:
+        await stats_snapshot.stop()
+        await datasets.stop()
+        datasets.close_all()
+        aggregation_pool.shutdown()
+        await client.aclose()
+
+
+server = FastMCP("3xpl_API", lifespan=lifespan)
 init_tools(server)
 init_prompts(server)
+init_resources(server)
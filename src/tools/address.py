@@ -1,6 +1,13 @@
-from src.core.connector import fetch_address
+from src.core.connector import fetch_address, RequestProfile
 from src.core.utils import format_amount, reformat_time
 
+# pending events counted per module. events need only the newest row, but the limit applies to all sections
+# of a request, so they take the same limit to keep the overview in one request
+OVERVIEW_ROWS = 100
+# the newest event per module, pending events count and balances
+OVERVIEW_PROFILE = RequestProfile(("events", "balances", "mempool"),
+                                  {"events": OVERVIEW_ROWS, "mempool": OVERVIEW_ROWS}, "currencies,rates(usd)")
+
 
 async def get_address_overview(blockchain: str, address: str) -> str:
     """
@@ -12,7 +19,7 @@ async def get_address_overview(blockchain: str, address: str) -> str:
     """
     # TODO: clean up this mess.
 
-    address_info = await fetch_address(blockchain, address)
+    address_info = await fetch_address(blockchain, address, OVERVIEW_PROFILE)
     mempool_module_count = {module: len(transactions) for module, transactions in
                             address_info['data']['mempool'].items()}
     mempool_transactions_count = sum(mempool_module_count.values())
@@ -36,6 +43,8 @@ async def get_address_overview(blockchain: str, address: str) -> str:
 
     if mempool_transactions_count == 0:
         mempool_text = "There is no pending transactions for this address."
+    elif max(mempool_module_count.values()) >= OVERVIEW_ROWS:
+        mempool_text = f"There is at least {mempool_transactions_count} pending transactions for this address."
     else:
         mempool_text = f"There is {mempool_transactions_count} pending transactions for this address."
 
@@ -1,10 +1,23 @@
+import asyncio
 import functools
+from collections.abc import AsyncIterator, Callable, Hashable
+from contextlib import aclosing
+from datetime import timedelta
+from typing import Any, Optional
 
+from src.core import columnar
 from src.core.connector import fetch_block_events, fetch_transaction_events, fetch_address_data, \
-    fetch_address_balances
-from src.core.db import unwrap_into_table, setup_sqlite_connection, get_aggregate
+    fetch_address_balances, fetch_block, confirmations_ttl, RequestProfile
+from src.core.config import config
+from src.core.datasets import Dataset, datasets, result_cache
+from src.core.db import db_executor, QueryResult, collect_rows
 from src.core.enums import AddressDataSource
-from src.core.utils import collect_all_pages
+from src.core.stats import stats_snapshot
+from src.core.query import analyze_query, prune_columns, normalize_sql, match_group_aggregate, QueryPlan
+from src.core.utils import iter_pages, window_pages, month_segments, merge_page_streams, tag_pages, unwrap_page, \
+    parse_utc
+from src.core.warehouse import event_warehouse, EVENT_COLUMNS
+from src.core.workers import aggregation_pool
 
 
 # current state of actions:
@@ -16,19 +29,306 @@ from src.core.utils import collect_all_pages
 #           - not passing modules correctly unless provided with exact module name
 #           (need to make it to look up modules though?)
 
-# TODO: segmenting on an address transfers.
-#  For example allowing inputting 30 days range and querying stuff on this range.
-#  And then aggregating.
-#  upd: non-trivial feature. Might require O(segments + page(segment_i)) of requests
-
 # TODO: when going out of allowed range for pages, notifying LLM about boundaries.
 #   for example telling the time of first event
 
+BLOCK_TRANSFERS_COLUMNS = {
+    "transaction_hash": "TEXT", "address": "TEXT", "currency_id": "TEXT",
+    "effect": "REAL", "failed": "BOOLEAN", "extra": "TEXT", "currency_symbol": "TEXT",
+    "currency_verified": "BOOLEAN", "currency_decimals": "TINYINT", "exchange_rate": "REAL",
+}
+BLOCK_RANGE_TRANSFERS_COLUMNS = {"block": "INT", **BLOCK_TRANSFERS_COLUMNS}
+TRANSACTION_TRANSFERS_COLUMNS = {
+    "address": "TEXT", "currency_id": "TEXT", "effect": "REAL", "failed": "BOOLEAN", "extra": "TEXT",
+    "currency_symbol": "TEXT", "currency_verified": "BOOLEAN", "currency_decimals": "TINYINT",
+    "exchange_rate": "REAL",
+}
+MEMPOOL_TRANSFERS_COLUMNS = {
+    "transaction_hash": "TEXT", "time": "TEXT", "currency_id": "TEXT",
+    "effect": "REAL", "failed": "BOOLEAN", "extra": "TEXT", "currency_symbol": "TEXT",
+    "currency_verified": "BOOLEAN", "currency_decimals": "TINYINT", "exchange_rate": "REAL",
+}
+# TODO: renaming decimals -> currency decimals as in others?
+BALANCES_COLUMNS = {
+    "currency_id": "TEXT", "symbol": "TEXT", "decimals": "INT", "balance": "REAL", "is_verified": "BOOLEAN",
+    "exchange_rate": "REAL",
+}
+# `module` value aggregating all modules of the blockchain at once
+ALL_MODULES = "all"
+
+BLOCK_TIME_PROFILE = RequestProfile(("block",))
+
+
+async def block_window_times(blockchain: str, since: Optional[str], until: Optional[str],
+                             from_block: Optional[int], to_block: Optional[int]) -> tuple[Optional[str], Optional[str]]:
+    """
+    Time bounds of a block window given without them, so older blocks are reached through month segments
+    like a time window, instead of paging down from the newest events up to `pagination_limit`.
+    Only `from_block` gives the start of the window, without it time bounds are left as they are.
+    """
+    if from_block is None or since is not None or until is not None:
+        return since, until
+    best_block = await stats_snapshot.best_block(blockchain)
+    # blocks ahead of the best one have no transfers yet
+    since = (await fetch_block(blockchain, min(from_block, best_block), BLOCK_TIME_PROFILE))['data']['block']['time']
+    if to_block is not None and to_block < best_block:
+        to_block_time = (await fetch_block(blockchain, to_block, BLOCK_TIME_PROFILE))['data']['block']['time']
+        # transfers of `to_block` have its time and `until` is exclusive
+        until = (parse_utc(to_block_time) + timedelta(seconds=1)).isoformat()
+    return since, until
+
+
 # todo: docstrings actually can be assigned separately:
 #  `fn.__doc__ = "description"` and this could be reducing some duplication.
 #  so having modularizing descriptions based on fields, and pasting that via formatting if it's needed for the tool.
 
 
+def columnar_enabled() -> bool:
+    return config.columnar_enabled and columnar.np is not None
+
+
+def cached_result(source: Hashable, sql_query: str) -> Optional[dict]:
+    """
+    Result of the same query over data from the same source, with a dataset still loaded from it if there's one.
+    """
+    aggregate = result_cache.get((source, normalize_sql(sql_query)))
+    if aggregate is None:
+        return None
+    dataset = datasets.find(source, sql_query)
+    return {"dataset_id": None if dataset is None else dataset.dataset_id, **aggregate.as_dict()}
+
+
+def cache_result(source: Hashable, sql_query: str, aggregate: QueryResult, ttl: Optional[float]):
+    # aborted queries could fit the limits next time
+    if aggregate.aborted is None and (ttl is None or ttl > 0):
+        result_cache.set((source, normalize_sql(sql_query)), aggregate, aggregate.size, ttl)
+
+
+async def fetch_and_aggregate(keys: dict, sql_query: str, async_fetcher, data_keys: list[str],
+                              get_currency_info: bool, source: Hashable,
+                              result_ttl: Callable[[Any], Optional[float]], stop_after_first: bool = False,
+                              count_keys: Optional[list[str]] = None, newest_first: bool = False,
+                              sized_pages: bool = True):
+    """
+    Fetches pages into `data` table and runs the query over it.
+    Fetching is narrowed down to what the query needs, see `analyze_query`.
+    Simple aggregations over whole datasets are computed on columns when the columnar backend is enabled,
+    other queries over whole datasets go to the aggregation process pool when it's enabled.
+    :param source: identity of the fetched data(e.g. blockchain, module and block), results are cached by it.
+    :param result_ttl: gets the first fetched page and tells for how long the result can be cached:
+        `None` - forever, 0 - not at all.
+    :param newest_first: pages go from newest to oldest events.
+    :param sized_pages: the API cuts pages at the requested limit, so a short page is the last one.
+        Balances don't honour the limit.
+    """
+    cached = cached_result(source, sql_query)
+    if cached is not None:
+        return cached
+
+    plan = analyze_query(sql_query, keys, newest_first_columns=["block", "time"] if newest_first else ())
+    first_page = None
+
+    async def fetch_page(page: int):
+        nonlocal first_page
+        data = await async_fetcher(limit=plan.page_size(), page=page)
+        if page == 0:
+            first_page = data
+        return data
+
+    pages_args = dict(data_keys=data_keys, get_currency_info=get_currency_info, stop_after_first=stop_after_first,
+                      count_keys=count_keys, page_size=plan.page_size() if sized_pages else None,
+                      max_pages=plan.max_pages())
+
+    def open_pages(unwrap: bool = True) -> AsyncIterator:
+        return iter_pages(fetch_page, **pages_args, unwrap=unwrap)
+
+    return await aggregate_pages(keys, sql_query, plan, open_pages, source, lambda: result_ttl(first_page),
+                                 unwrap_args=(data_keys, get_currency_info), newest_first=newest_first)
+
+
+async def aggregate_pages(keys: dict, sql_query: str, plan: QueryPlan, open_pages: Callable[..., AsyncIterator],
+                          source: Hashable, result_ttl: Callable[[], Optional[float]],
+                          unwrap_args: Optional[tuple[list[str], bool]] = None, newest_first: bool = False) -> dict:
+    """
+    Loads pages from `open_pages(unwrap)` and runs the query over them:
+    on columns, in the aggregation process pool or in a dataset kept for follow-up queries.
+    :param result_ttl: called once pages are loaded, tells for how long the result can be cached.
+    :param unwrap_args: `data_keys` and `get_currency_info` to unwrap raw pages in the process pool,
+        the pool isn't used without them.
+    """
+    async def query_pages(pages: AsyncIterator[list]) -> dict:
+        async with Dataset(keys, None if plan.loads_everything else sql_query, source) as dataset:
+            # validate_sql(conn, sql_query)
+            await dataset.load(pages)
+            return await query_and_keep(dataset, sql_query, result_ttl(), keep=plan.loads_everything)
+
+    group_aggregate = match_group_aggregate(sql_query, keys) if columnar_enabled() else None
+    if group_aggregate is not None and plan.loads_everything:
+        async with aclosing(open_pages()) as page_stream:
+            fetched_pages = [page async for page in page_stream]
+        rows = await db_executor.run(columnar.aggregate_columns, fetched_pages, keys, group_aggregate)
+        if rows is not None:
+            aggregate = collect_rows(QueryResult([]), rows)
+            cache_result(source, sql_query, aggregate, result_ttl())
+            return {"dataset_id": None, **aggregate.as_dict()}
+        # values don't fit the columns, SQLite gets the same pages
+        return await query_pages(chain_pages(fetched_pages))
+    elif aggregation_pool.enabled and plan.loads_everything and unwrap_args is not None:
+        # pages are unwrapped in the worker as well, the table stays there too
+        async with aclosing(open_pages(unwrap=False)) as page_stream:
+            fetched_pages = []
+            async for data in page_stream:
+                fetched_pages.append(data)
+                if len(fetched_pages) > config.aggregation_worker_max_pages:
+                    # too many to hold in memory, these and the rest go to a dataset as they arrive
+                    return await query_pages(chain_pages(fetched_pages, page_stream, unwrap_args))
+        aggregate = await aggregation_pool.aggregate(fetched_pages, *unwrap_args,
+                                                     prune_columns(keys, sql_query), sql_query)
+        cache_result(source, sql_query, aggregate, result_ttl())
+        return {"dataset_id": None, **aggregate.as_dict()}
+
+    return await query_pages(plan.narrow(open_pages(), newest_first))
+
+
+async def chain_pages(fetched_pages: list, page_stream: Optional[AsyncIterator] = None,
+                      unwrap_args: Optional[tuple[list[str], bool]] = None) -> AsyncIterator[list]:
+    """
+    Yields pages fetched already, then the rest of `page_stream`.
+    :param unwrap_args: `data_keys` and `get_currency_info` to unwrap raw pages with.
+    """
+    for data in fetched_pages:
+        yield data if unwrap_args is None else unwrap_page(data, *unwrap_args)
+    if page_stream is not None:  # closed by whoever opened it
+        async for data in page_stream:
+            yield data if unwrap_args is None else unwrap_page(data, *unwrap_args)
+
+
+async def query_and_keep(dataset: Dataset, sql_query: str, ttl: Optional[float], keep: bool = True) -> dict:
+    """
+    Runs the first query over a loaded dataset, caches the result for `ttl`
+    and keeps the dataset for follow-up queries.
+    """
+    aggregate = await dataset.query(sql_query, index=keep)
+    cache_result(dataset.source, sql_query, aggregate, ttl)
+    kept = keep and await db_executor.run(datasets.keep, dataset)
+    return {"dataset_id": dataset.dataset_id if kept else None, **aggregate.as_dict()}
+
+
+async def blockchain_modules(blockchain: str, module: str) -> list[str]:
+    """
+    Modules to fetch: the `module` itself, or all modules of the blockchain for `ALL_MODULES`.
+    """
+    if module == ALL_MODULES:
+        return await stats_snapshot.modules(blockchain)
+    return [module]
+
+
+def owner_columns(keys: dict, module: str, batch: bool = False) -> dict:
+    """
+    `keys` with columns telling apart rows of several modules(for `ALL_MODULES`) or addresses(for batches).
+    """
+    owner_keys = {"module": "TEXT"} if module == ALL_MODULES else {}
+    if batch:
+        owner_keys["owner_address"] = "TEXT"
+    return {**owner_keys, **keys}
+
+
+async def aggregate_owners_balances(blockchain: str, owners: list[tuple[str, str]], keys: dict, sql_query: str,
+                                    source: Hashable, concurrency: int) -> dict:
+    """
+    Loads balances of several (module, address) owners into one `data` table and runs the query over it.
+    :param concurrency: max owners fetched at once.
+    """
+    cached = cached_result(source, sql_query)
+    if cached is not None:
+        return cached
+
+    def open_pages(unwrap: bool = True) -> AsyncIterator:
+        return merge_page_streams((
+            tag_pages(iter_pages(
+                functools.partial(fetch_address_balances, blockchain=blockchain, module=module, address=address,
+                                  source=AddressDataSource.balances),
+                [], get_currency_info=False, stop_after_first=module.endswith("-main"), page_size=None,
+            ), module=module, owner_address=address)
+            for module, address in owners
+        ), concurrency)
+
+    return await aggregate_pages(keys, sql_query, analyze_query(sql_query, keys), open_pages, source,
+                                 lambda: config.cache_ttl_address)
+
+
+async def aggregate_owners_transfers(blockchain: str, owners: list[tuple[str, str]], keys: dict, sql_query: str,
+                                     source: Hashable, concurrency: int,
+                                     since: Optional[str] = None, until: Optional[str] = None,
+                                     from_block: Optional[int] = None, to_block: Optional[int] = None) -> dict:
+    """
+    Loads confirmed transfers of several (module, address) owners into one `data` table
+    and runs the query over it, the same ways `aggregate_address_transfers` loads a single address.
+    :param concurrency: max owners(or their time segments) fetched at once.
+    """
+    def fetcher(module: str, address: str):
+        return functools.partial(fetch_address_data, blockchain=blockchain, module=module, address=address,
+                                 source=AddressDataSource.events)
+
+    windowed = any(bound is not None for bound in (since, until, from_block, to_block))
+    plan = analyze_query(sql_query, keys, newest_first_columns=["block", "time"])
+    ttl = config.cache_ttl_address if to_block is None else confirmations_ttl(blockchain, to_block)
+    cached = cached_result(source, sql_query)
+    if cached is not None:
+        return cached
+    since, until = await block_window_times(blockchain, since, until, from_block, to_block)
+    if not windowed and not plan.narrows_history and not config.warehouse_enabled:
+        def open_pages(unwrap: bool = True) -> AsyncIterator:
+            return merge_page_streams((
+                tag_pages(iter_pages(fetcher(module, address), ["data", "events", module], get_currency_info=True,
+                                     stop_after_first=False), module=module, owner_address=address)
+                for module, address in owners
+            ), concurrency)
+
+        return await aggregate_pages(keys, sql_query, plan, open_pages, source, lambda: ttl)
+
+    synced = config.warehouse_enabled and all([
+        await db_executor.run(event_warehouse.newest_block, blockchain, *owner) is not None for owner in owners
+    ])
+    # when query needs only the newest events, it's cheaper to fetch them than to sync the whole history
+    narrowed = since is None and (windowed or (plan.narrows_history and not synced))
+    complete = not narrowed or plan.loads_everything
+    async with Dataset(keys, None if complete else sql_query, source) as dataset:
+        if since is not None:
+            streams = [
+                tag_pages(window_pages(
+                    iter_pages(functools.partial(fetcher(module, address), segment=segment),
+                               data_keys=["data", "events", module], get_currency_info=True, stop_after_first=False),
+                    since, until, from_block, to_block,
+                ), module=module, owner_address=address)
+                for module, address in owners for segment in month_segments(since, until)
+            ]
+            await dataset.load(merge_page_streams(streams, concurrency))
+        elif narrowed:
+            # history of each owner goes newest first, so the plan narrows every one of them on its own:
+            # rows a query needs from all owners are among the rows it needs from each owner
+            streams = [
+                tag_pages(plan.narrow(window_pages(
+                    iter_pages(functools.partial(fetcher(module, address), limit=plan.page_size()),
+                               data_keys=["data", "events", module], get_currency_info=True, stop_after_first=False,
+                               page_size=plan.page_size(), max_pages=plan.max_pages()),
+                    since, until, from_block, to_block,
+                ), newest_first=True), module=module, owner_address=address)
+                for module, address in owners
+            ]
+            await dataset.load(merge_page_streams(streams, concurrency))
+        else:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def sync(module: str, address: str):
+                async with semaphore:
+                    await event_warehouse.sync_address(blockchain, module, address, fetcher(module, address))
+
+            await asyncio.gather(*(sync(*owner) for owner in owners))
+            await dataset.run(event_warehouse.load_into, dataset.keys, blockchain, *owners)
+        return await query_and_keep(dataset, sql_query, ttl, keep=complete)
+
+
 async def aggregate_block_transfers(blockchain: str, module: str, height: int, sql_query: str):
     """
     Aggregate *individual transfers* within a block in requested blockchain within requested module in a sqlite table.
@@ -64,31 +364,103 @@ async def aggregate_block_transfers(blockchain: str, module: str, height: int, s
         height (int): block height in the requested blockchain
         sql_query (str): sqlite syntax query to aggregate transfer data
     Returns:
-        dict: aggregated result of a query
+        dict: `result` of the query and `dataset_id` of the loaded table. Follow-up queries over the same data
+            should go to `query_dataset` with that `dataset_id` instead of fetching everything again.
+            `dataset_id` is null when only a part of the data was loaded for this query.
+            `truncated` is true when the result was cut to fit the limits, aggregate more or use LIMIT then.
+            `aborted` tells why a too expensive query was interrupted, `result` has rows fetched before that.
     """
-    conn = setup_sqlite_connection()
-    # validate_sql(conn, sql_query)
-
-    all_block_events = await collect_all_pages(
+    aggregate = await fetch_and_aggregate(
+        BLOCK_TRANSFERS_COLUMNS, sql_query,
         functools.partial(fetch_block_events, blockchain=blockchain, module=module, height=height),
-        ["data", "events", module], get_currency_info=True, stop_after_first=False,
+        ["data", "events", module], get_currency_info=True,
+        source=("block", blockchain, module, height),
+        result_ttl=lambda data: confirmations_ttl(blockchain, height),
+        count_keys=["data", "block", "events", module],
     )
-    unwrap_into_table(
-        conn,
-        {"transaction_hash": "TEXT", "address": "TEXT", "currency_id": "TEXT",
-         "effect": "REAL", "failed": "BOOLEAN", "extra": "TEXT", "currency_symbol": "TEXT",
-         "currency_verified": "BOOLEAN", "currency_decimals": "TINYINT", "exchange_rate": "REAL"},
-        all_block_events)
-    aggregate = get_aggregate(conn, sql_query)
     return aggregate
 
 
+async def aggregate_block_range_transfers(blockchain: str, module: str, from_block: int, to_block: int,
+                                          sql_query: str):
+    """
+    Aggregate *individual transfers* within a range of blocks in requested blockchain within requested module
+    in a single sqlite table, e.g. to compare blocks or to sum fees over a period.
+    Schema:
+        table is called data and contains the following columns:
+        - block: height of the block the transfer is in
+        - transaction_hash: transaction hash as text
+        - address: target address of the transfer as text
+        - currency_id: currency identifier in lowercase. Can be native currency name (e.g. `ethereum`, `bitcoin`)
+            or contract address prefixed with the module name and separated by a slash
+            (e.g. `ethereum-erc-20/0xda...c7` (address shortened for simplicity)
+        - currency_symbol: currency symbol/ticker) in uppercase.
+        - currency_decimals: number of decimals for the currency. 0 if the currency is indivisible(nft).
+        - currency_verified: boolean indicating whether the currency is widely accepted and listed on major exchanges(indicates that a currency is not a scam or copy)
+        - exchange_rate: exchange rate for the currency in USD. Null if the currency is not listed anywhere yet.
+        - effect: amount in the smallest units as REAL type. Positive if the address is receiver, negative if is sender.
+        - failed: boolean indicating whether transaction failed
+        - extra: Special marker describing the type of transfer as text field. Possible values:
+            'r' for block reward
+            'f' for miner fee
+            'b' for burnt fee
+            'i' for uncle inclusion reward
+            'u' for uncle reward
+            'c' for contract creation
+            'd' for contract destruction
+            null for Regular/ordinary transfer (no special type)
+            NOTICE: in UTXO blockchains transfers extra will be always null. Here are other traits of transfers:
+            - in UTXO blockchains, miner fee(including block reward) will be the sum of transfers where special address `the-void` is receiver.
+            - block reward is the transfer where special address `the-void` is sender. Keep in mind that this also includes the miner fees.
+    Args:
+        blockchain (str): blockchain to fetch from
+        module (str): module of the blockchain.
+            Must always be prepended with blockchain name. Example: "arbitrum-one-erc-20"
+        from_block (int): first block height of the range
+        to_block (int): last block height of the range(inclusive)
+        sql_query (str): sqlite syntax query to aggregate transfer data.
+            Conditions on `block` narrow down the blocks which are fetched.
+    Returns:
+        dict: `result` of the query and `dataset_id` of the loaded table. Follow-up queries over the same data
+            should go to `query_dataset` with that `dataset_id` instead of fetching everything again.
+            `dataset_id` is null when only a part of the data was loaded for this query.
+            `truncated` is true when the result was cut to fit the limits, aggregate more or use LIMIT then.
+            `aborted` tells why a too expensive query was interrupted, `result` has rows fetched before that.
+    """
+    if not 0 <= to_block - from_block < config.block_range_max_blocks:
+        raise ValueError(f"Block range has to contain from 1 to {config.block_range_max_blocks} blocks")
+    source = ("blocks", blockchain, module, from_block, to_block)
+    cached = cached_result(source, sql_query)
+    if cached is not None:
+        return cached
+
+    plan = analyze_query(sql_query, BLOCK_RANGE_TRANSFERS_COLUMNS)
+    # blocks outside of the query's bounds aren't fetched at all
+    heights = range(max(from_block, plan.from_block if plan.from_block is not None else from_block),
+                    min(to_block, plan.to_block if plan.to_block is not None else to_block) + 1)
+
+    def block_pages(height: int) -> AsyncIterator[list]:
+        return tag_pages(iter_pages(
+            functools.partial(fetch_block_events, blockchain=blockchain, module=module, height=height),
+            ["data", "events", module], get_currency_info=True, stop_after_first=False,
+            count_keys=["data", "block", "events", module], concurrency=1,
+        ), block=height)
+
+    def open_pages(unwrap: bool = True) -> AsyncIterator:
+        # blocks are fetched in parallel rather than pages of one block
+        return merge_page_streams(map(block_pages, heights), config.block_range_concurrency)
+
+    return await aggregate_pages(BLOCK_RANGE_TRANSFERS_COLUMNS, sql_query, plan, open_pages, source,
+                                 lambda: confirmations_ttl(blockchain, to_block))
+
+
 # TODO: making it lookup the documentation before?
 async def aggregate_transaction_transfers(blockchain: str, module: str, transaction_hash: str, sql_query: str):
     """
     Aggregate *individual transfers* within a transaction in requested blockchain within requested module in a sqlite table.
     Schema:
         table is called data and contains the following columns:
+        - module: module the row comes from, only when `module` is "all"
         - address: target address of the transfer as text
         - currency_id: currency identifier in lowercase. Can be native currency name (e.g. `ethereum`, `bitcoin`)
             or contract address prefixed with the module name and separated by a slash
@@ -115,27 +487,51 @@ async def aggregate_transaction_transfers(blockchain: str, module: str, transact
         blockchain (str): blockchain to fetch from
         module (str): module of the blockchain.
             Must always be prepended with blockchain name. Example: "arbitrum-one-erc-20".
+            Pass "all" to aggregate all modules of the blockchain at once.
         transaction_hash (str): hash of the transaction to aggregate
         sql_query (str): sqlite syntax query to aggregate transfer data
     Returns:
-        dict: aggregated result of a query
+        dict: `result` of the query and `dataset_id` of the loaded table. Follow-up queries over the same data
+            should go to `query_dataset` with that `dataset_id` instead of fetching everything again.
+            `dataset_id` is null when only a part of the data was loaded for this query.
+            `truncated` is true when the result was cut to fit the limits, aggregate more or use LIMIT then.
+            `aborted` tells why a too expensive query was interrupted, `result` has rows fetched before that.
     """
-    conn = setup_sqlite_connection()
-    # validate_sql(conn, sql_query)
+    if module == ALL_MODULES:
+        keys = owner_columns(TRANSACTION_TRANSFERS_COLUMNS, module)
+        source = ("transaction", blockchain, module, transaction_hash)
+        cached = cached_result(source, sql_query)
+        if cached is not None:
+            return cached
+        blocks = []
+
+        def module_pages(module_: str) -> AsyncIterator[list]:
+            async def fetch_page(page: int):
+                data = await fetch_transaction_events(blockchain, module_, transaction_hash, page=page)
+                blocks.append(data['data']['transaction'].get('block'))
+                return data
+
+            return tag_pages(iter_pages(fetch_page, ["data", "events", module_], get_currency_info=True,
+                                        stop_after_first=False, count_keys=["data", "transaction", "events", module_]),
+                             module=module_)
+
+        modules = await blockchain_modules(blockchain, module)
+
+        def open_pages(unwrap: bool = True) -> AsyncIterator:
+            return merge_page_streams(map(module_pages, modules), config.module_concurrency)
+
+        return await aggregate_pages(keys, sql_query, analyze_query(sql_query, keys), open_pages, source,
+                                     lambda: confirmations_ttl(blockchain, blocks[0] if blocks else None))
 
-    all_tx_events = await collect_all_pages(
+    aggregate = await fetch_and_aggregate(
+        TRANSACTION_TRANSFERS_COLUMNS, sql_query,
         functools.partial(fetch_transaction_events, blockchain=blockchain, module=module,
                           transaction_hash=transaction_hash),
-        data_keys=["data", "events", module], get_currency_info=True, stop_after_first=False
+        data_keys=["data", "events", module], get_currency_info=True,
+        source=("transaction", blockchain, module, transaction_hash),
+        result_ttl=lambda data: confirmations_ttl(blockchain, data['data']['transaction'].get('block')),
+        count_keys=["data", "transaction", "events", module],
     )
-    unwrap_into_table(
-        conn,
-        {"address": "TEXT", "currency_id": "TEXT", "effect": "REAL", "failed": "BOOLEAN", "extra": "TEXT",
-         "currency_symbol": "TEXT", "currency_verified": "BOOLEAN", "currency_decimals": "TINYINT",
-         "exchange_rate": "REAL"},
-        all_tx_events,
-    )
-    aggregate = get_aggregate(conn, sql_query)
     return aggregate
 
 
@@ -174,23 +570,20 @@ async def aggregate_address_mempool(blockchain: str, module: str, address: str,
         address (str): address to get mempool data for
         sql_query (str): sqlite syntax query to aggregate transfer data
     Returns:
-        dict: aggregated result of a query
+        dict: `result` of the query and `dataset_id` of the loaded table. Follow-up queries over the same data
+            should go to `query_dataset` with that `dataset_id` instead of fetching everything again.
+            `dataset_id` is null when only a part of the data was loaded for this query.
+            `truncated` is true when the result was cut to fit the limits, aggregate more or use LIMIT then.
+            `aborted` tells why a too expensive query was interrupted, `result` has rows fetched before that.
     """
-    conn = setup_sqlite_connection()
-    # validate_sql(conn, sql_query)
-
-    all_mempool_events = await collect_all_pages(
+    aggregate = await fetch_and_aggregate(
+        MEMPOOL_TRANSFERS_COLUMNS, sql_query,
         functools.partial(fetch_address_data, blockchain=blockchain, module=module, address=address,
                           source=AddressDataSource.mempool),
-        data_keys=["data", "mempool", module], get_currency_info=True, stop_after_first=False,
+        data_keys=["data", "mempool", module], get_currency_info=True,
+        source=("mempool", blockchain, module, address),
+        result_ttl=lambda data: config.cache_ttl_mempool,
     )
-    unwrap_into_table(
-        conn,
-        {"transaction_hash": "TEXT", "time": "TEXT", "currency_id": "TEXT",
-         "effect": "REAL", "failed": "BOOLEAN", "extra": "TEXT", "currency_symbol": "TEXT",
-         "currency_verified": "BOOLEAN", "currency_decimals": "TINYINT", "exchange_rate": "REAL"},
-        all_mempool_events)
-    aggregate = get_aggregate(conn, sql_query)
     return aggregate
 
 
@@ -199,6 +592,7 @@ async def aggregate_address_balances(blockchain: str, module: str, address: str,
     Aggregate *balance info* for an address in requested blockchain within requested module in a sqlite table.
     Schema:
         table is called data and it contains following columns:
+        - module: module the row comes from, only when `module` is "all"
         - currency_id: currency identifier in lowercase. Can be native currency name (e.g. `ethereum`, `bitcoin`)
             or contract address prefixed with the module name and separated by a slash
             (e.g. `ethereum-erc-20/0xda...c7` (address shortened for simplicity)
@@ -227,34 +621,40 @@ async def aggregate_address_balances(blockchain: str, module: str, address: str,
         blockchain (str): Blockchain to fetch from.
         module (str): Module of the blockchain.
             Must always be prepended with blockchain name. Example: "arbitrum-one-erc-20".
+            Pass "all" to aggregate all modules of the blockchain at once.
         address (str): Address to get balances for.
         sql_query (str): SQLite syntax query to aggregate balance data.
     Returns:
-        dict: aggregated result of a query
+        dict: `result` of the query and `dataset_id` of the loaded table. Follow-up queries over the same data
+            should go to `query_dataset` with that `dataset_id` instead of fetching everything again.
+            `dataset_id` is null when only a part of the data was loaded for this query.
+            `truncated` is true when the result was cut to fit the limits, aggregate more or use LIMIT then.
+            `aborted` tells why a too expensive query was interrupted, `result` has rows fetched before that.
     """
-    conn = setup_sqlite_connection()
-    # validate_sql(conn, sql_query)
-
-    all_balances = await collect_all_pages(
+    if module == ALL_MODULES:
+        owners = [(module_, address) for module_ in await blockchain_modules(blockchain, module)]
+        return await aggregate_owners_balances(blockchain, owners, owner_columns(BALANCES_COLUMNS, module), sql_query,
+                                               ("balances", blockchain, module, address), config.module_concurrency)
+    aggregate = await fetch_and_aggregate(
+        BALANCES_COLUMNS, sql_query,
         functools.partial(fetch_address_balances, blockchain=blockchain, module=module, address=address,
                           source=AddressDataSource.balances),
-        [], get_currency_info=False, stop_after_first=module.endswith("-main")
+        [], get_currency_info=False,
+        source=("balances", blockchain, module, address),
+        result_ttl=lambda data: config.cache_ttl_address,
+        stop_after_first=module.endswith("-main"), sized_pages=False,
     )
-    unwrap_into_table(
-        conn,  # TODO: renaming decimals -> currency decimals as in others?
-        {"currency_id": "TEXT", "symbol": "TEXT", "decimals": "INT", "balance": "REAL", "is_verified": "BOOLEAN",
-         "exchange_rate": "REAL"},
-        all_balances
-    )
-    aggregate = get_aggregate(conn, sql_query)
     return aggregate
 
 
-async def aggregate_address_transfers(blockchain: str, module: str, address: str, sql_query: str):
+async def aggregate_address_transfers(blockchain: str, module: str, address: str, sql_query: str,
+                                      since: Optional[str] = None, until: Optional[str] = None,
+                                      from_block: Optional[int] = None, to_block: Optional[int] = None):
     """
     Aggregate *confirmed individual transfers* for an address in requested blockchain within requested module in a sqlite table.
     Schema:
         table is called data and contains the following columns:
+        - module: module the row comes from, only when `module` is "all"
         - block: block height as integer
         - transaction_hash: transaction hash as text
         - time: ISO timestamp of the event as text
@@ -283,27 +683,230 @@ async def aggregate_address_transfers(blockchain: str, module: str, address: str
         blockchain (str): blockchain to fetch from
         module (str): module of the blockchain
             Must always be prepended with blockchain name. Example: "arbitrum-one-erc-20".
+            Pass "all" to aggregate all modules of the blockchain at once.
         address (str): address to get transfer data for
         sql_query (str): sqlite syntax query to aggregate transfer data
+        since (str, optional): ISO date or datetime in UTC(e.g. `2024-03-01`), only transfers at or after it are loaded.
+            Use it for questions about a period, it allows reaching the older history of busy addresses.
+        until (str, optional): ISO date or datetime in UTC, only transfers before it are loaded.
+            For example, March 2024 is since=`2024-03-01`, until=`2024-04-01`.
+        from_block (int, optional): only transfers in this block or later are loaded.
+            Blocks are fetched by months of their time like with `since`, so older blocks are reached as well.
+        to_block (int, optional): only transfers in this block or earlier are loaded.
+            Without `from_block` or `since`, transfers are fetched from the newest ones down to `to_block` first,
+            so for busy addresses older history can be cut by the pagination limit. Pass `from_block` as well.
     Returns:
-        dict: aggregated result of a query
+        dict: `result` of the query and `dataset_id` of the loaded table. Follow-up queries over the same data
+            should go to `query_dataset` with that `dataset_id` instead of fetching everything again.
+            `dataset_id` is null when only a part of the data was loaded for this query.
+            `truncated` is true when the result was cut to fit the limits, aggregate more or use LIMIT then.
+            `aborted` tells why a too expensive query was interrupted, `result` has rows fetched before that.
     """
-    conn = setup_sqlite_connection()
-    # validate_sql(conn, sql_query)
+    if module == ALL_MODULES:
+        owners = [(module_, address) for module_ in await blockchain_modules(blockchain, module)]
+        return await aggregate_owners_transfers(
+            blockchain, owners, owner_columns(EVENT_COLUMNS, module), sql_query,
+            ("address", blockchain, module, address, since, until, from_block, to_block),
+            config.module_concurrency, since, until, from_block, to_block,
+        )
+    fetcher = functools.partial(fetch_address_data, blockchain=blockchain, module=module, address=address,
+                                source=AddressDataSource.events)
+    windowed = any(bound is not None for bound in (since, until, from_block, to_block))
+    plan = analyze_query(sql_query, EVENT_COLUMNS, newest_first_columns=["block", "time"])
+    source = ("address", blockchain, module, address, since, until, from_block, to_block)
+    # transfers up to a final block don't change anymore
+    ttl = config.cache_ttl_address if to_block is None else confirmations_ttl(blockchain, to_block)
+    if not windowed and not plan.narrows_history and not config.warehouse_enabled:
+        return await fetch_and_aggregate(EVENT_COLUMNS, sql_query, fetcher, data_keys=["data", "events", module],
+                                         get_currency_info=True, source=source, result_ttl=lambda data: ttl,
+                                         newest_first=True)
+    cached = cached_result(source, sql_query)
+    if cached is not None:
+        return cached
+    since, until = await block_window_times(blockchain, since, until, from_block, to_block)
 
-    all_address_events = await collect_all_pages(
-        functools.partial(fetch_address_data, blockchain=blockchain, module=module, address=address,
-                          source=AddressDataSource.events),
-        data_keys=["data", "events", module], get_currency_info=True, stop_after_first=False
-    )
-    # made number real, so LLM can operate on it without casting.
-    # but it has a downside of decreased accuracy.
-    unwrap_into_table(
-        conn,
-        {"block": "INT", "transaction_hash": "TEXT", "time": "TEXT", "currency_id": "TEXT",
-         "effect": "REAL", "failed": "BOOLEAN", "extra": "TEXT", "currency_symbol": "TEXT",
-         "currency_verified": "BOOLEAN", "currency_decimals": "TINYINT", "exchange_rate": "REAL"},
-        all_address_events
+    synced = config.warehouse_enabled and \
+        await db_executor.run(event_warehouse.newest_block, blockchain, module, address) is not None
+    # when query needs only the newest events, it's cheaper to fetch them than to sync the whole history
+    narrowed = since is None and (windowed or (plan.narrows_history and not synced))
+    complete = not narrowed or plan.loads_everything
+    async with Dataset(EVENT_COLUMNS, None if complete else sql_query, source) as dataset:
+        # validate_sql(conn, sql_query)
+        if since is not None:
+            # time range is split into monthly segments which are fetched concurrently
+            segment_pages = [
+                window_pages(
+                    iter_pages(functools.partial(fetcher, segment=segment), data_keys=["data", "events", module],
+                               get_currency_info=True, stop_after_first=False),
+                    since, until, from_block, to_block,
+                )
+                for segment in month_segments(since, until)
+            ]
+            await dataset.load(merge_page_streams(segment_pages, config.segment_concurrency))
+        elif narrowed:
+            await dataset.load(plan.narrow(window_pages(
+                iter_pages(functools.partial(fetcher, limit=plan.page_size()), data_keys=["data", "events", module],
+                           get_currency_info=True, stop_after_first=False, page_size=plan.page_size(),
+                           max_pages=plan.max_pages()),
+                since, until, from_block, to_block,
+            ), newest_first=True))
+        else:
+            # only events newer than the previous sync are fetched, the rest comes from the local copy
+            await event_warehouse.sync_address(blockchain, module, address, fetcher)
+            await dataset.run(event_warehouse.load_into, dataset.keys, blockchain, (module, address))
+        return await query_and_keep(dataset, sql_query, ttl, keep=complete)
+
+
+def batch_addresses(addresses: list[str]) -> list[str]:
+    addresses = sorted(set(addresses))  # order doesn't change the loaded table
+    if not 0 < len(addresses) <= config.address_batch_max_addresses:
+        raise ValueError(f"From 1 to {config.address_batch_max_addresses} addresses can be aggregated at once")
+    return addresses
+
+
+async def aggregate_addresses_balances(blockchain: str, module: str, addresses: list[str], sql_query: str):
+    """
+    Aggregate *balance info* for several addresses(e.g. a portfolio or a cluster) at once
+    in requested blockchain within requested module in a single sqlite table.
+    Schema:
+        table is called data and it contains following columns:
+        - module: module the row comes from, only when `module` is "all"
+        - owner_address: the address the balance belongs to, as it was passed in `addresses`
+        - currency_id: currency identifier in lowercase. Can be native currency name (e.g. `ethereum`, `bitcoin`)
+            or contract address prefixed with the module name and separated by a slash
+            (e.g. `ethereum-erc-20/0xda...c7` (address shortened for simplicity)
+        - symbol: symbol in uppercase(ticker) - can be the same for multiple currencies, so check address or whether it's verified.
+        - decimals: number of decimals of the currency.
+        - balance: amount of currency on the balance in the smallest unit(that's why you need decimals).
+            Stored as REAL type.
+            Null if the currency is non-fungible.
+        - is_verified: boolean indicating whether the currency is widely accepted and listed on major exchanges(indicates that a currency is not a scam or copy)
+        - exchange_rate: exchange rate for the currency in USD. Null if the currency is not listed anywhere yet.
+        in case if you query main module, there will be only row(example with `ethereum-main`):
+        currency - "ethereum"
+        symbol - "ETH"
+        decimals - 18
+        balance - "237558121960475169592"
+        etc...
+
+        but when you query other modules, the currency will be in form of an address and prepended with module name:
+
+        currency - "ethereum-erc-20/0xdAC...1ec7"
+        symbol - "USDT"
+        decimals - 18
+        balance": "113231423123"
+
+    Args:
+        blockchain (str): Blockchain to fetch from.
+        module (str): Module of the blockchain.
+            Must always be prepended with blockchain name. Example: "arbitrum-one-erc-20".
+            Pass "all" to aggregate all modules of the blockchain at once.
+        addresses (list[str]): Addresses to get balances for, up to 50.
+        sql_query (str): SQLite syntax query to aggregate balance data.
+    Returns:
+        dict: `result` of the query and `dataset_id` of the loaded table. Follow-up queries over the same data
+            should go to `query_dataset` with that `dataset_id` instead of fetching everything again.
+            `dataset_id` is null when only a part of the data was loaded for this query.
+            `truncated` is true when the result was cut to fit the limits, aggregate more or use LIMIT then.
+            `aborted` tells why a too expensive query was interrupted, `result` has rows fetched before that.
+    """
+    addresses = batch_addresses(addresses)
+    owners = [(module_, address) for module_ in await blockchain_modules(blockchain, module) for address in addresses]
+    return await aggregate_owners_balances(blockchain, owners, owner_columns(BALANCES_COLUMNS, module, batch=True),
+                                           sql_query, ("balances", blockchain, module, tuple(addresses)),
+                                           config.address_batch_concurrency)
+
+
+async def aggregate_addresses_transfers(blockchain: str, module: str, addresses: list[str], sql_query: str,
+                                        since: Optional[str] = None, until: Optional[str] = None,
+                                        from_block: Optional[int] = None, to_block: Optional[int] = None):
+    """
+    Aggregate *confirmed individual transfers* for several addresses(e.g. a portfolio or a cluster) at once
+    in requested blockchain within requested module in a single sqlite table.
+    Schema:
+        table is called data and contains the following columns:
+        - module: module the row comes from, only when `module` is "all"
+        - owner_address: the address the transfer belongs to, as it was passed in `addresses`
+        - block: block height as integer
+        - transaction_hash: transaction hash as text
+        - time: ISO timestamp of the event as text
+        - currency_id: currency identifier in lowercase. Can be native currency name (e.g. `ethereum`, `bitcoin`)
+            or contract address prefixed with the module name and separated by a slash
+            (e.g. `ethereum-erc-20/0xda...c7` (address shortened for simplicity)
+        - currency_symbol: currency symbol/ticker) in uppercase.
+        - currency_decimals: number of decimals for the currency. 0 if the currency is indivisible(nft).
+        - currency_verified: boolean indicating whether the currency is widely accepted and listed on major exchanges(indicates that a currency is not a scam or copy)
+        - effect: amount in the smallest units as REAL type. Positive if the owner address is receiver, negative if is sender.
+        - exchange_rate: exchange rate for the currency in USD. Null if the currency is not listed anywhere yet.
+        - failed: boolean indicating whether transaction failed
+        - extra: Special marker describing the type of transfer as tet field. Possible values:
+            'r' for block reward
+            'f' for miner fee
+            'b' for burnt fee
+            'i' for uncle inclusion reward
+            'u' for uncle reward
+            'c' for contract creation
+            'd' for contract destruction
+            null for Regular/ordinary transfer (no special type)
+            NOTICE: in UTXO blockchains transfers extra will be always null. Here are other traits of transfers:
+            - in UTXO blockchains, miner fee(including block reward) will be the sum of transfers where special address `the-void` is receiver.
+            - block reward is the transfer where special address `the-void` is sender. Keep in mind that this also includes the miner fees.
+    Args:
+        blockchain (str): blockchain to fetch from
+        module (str): module of the blockchain
+            Must always be prepended with blockchain name. Example: "arbitrum-one-erc-20".
+            Pass "all" to aggregate all modules of the blockchain at once.
+        addresses (list[str]): addresses to get transfer data for, up to 50
+        sql_query (str): sqlite syntax query to aggregate transfer data
+        since (str, optional): ISO date or datetime in UTC(e.g. `2024-03-01`), only transfers at or after it are loaded.
+            Use it for questions about a period, it allows reaching the older history of busy addresses.
+        until (str, optional): ISO date or datetime in UTC, only transfers before it are loaded.
+            For example, March 2024 is since=`2024-03-01`, until=`2024-04-01`.
+        from_block (int, optional): only transfers in this block or later are loaded.
+            Blocks are fetched by months of their time like with `since`, so older blocks are reached as well.
+        to_block (int, optional): only transfers in this block or earlier are loaded.
+            Without `from_block` or `since`, transfers are fetched from the newest ones down to `to_block` first,
+            so for busy addresses older history can be cut by the pagination limit. Pass `from_block` as well.
+    Returns:
+        dict: `result` of the query and `dataset_id` of the loaded table. Follow-up queries over the same data
+            should go to `query_dataset` with that `dataset_id` instead of fetching everything again.
+            `dataset_id` is null when only a part of the data was loaded for this query.
+            `truncated` is true when the result was cut to fit the limits, aggregate more or use LIMIT then.
+            `aborted` tells why a too expensive query was interrupted, `result` has rows fetched before that.
+    """
+    addresses = batch_addresses(addresses)
+    owners = [(module_, address) for module_ in await blockchain_modules(blockchain, module) for address in addresses]
+    return await aggregate_owners_transfers(
+        blockchain, owners, owner_columns(EVENT_COLUMNS, module, batch=True), sql_query,
+        ("addresses", blockchain, module, tuple(addresses), since, until, from_block, to_block),
+        config.address_batch_concurrency, since, until, from_block, to_block,
     )
-    aggregate = get_aggregate(conn, sql_query)
-    return aggregate
+
+
+async def query_dataset(dataset_id: str, sql_query: str):
+    """
+    Run another query over a table loaded by one of `aggregate_*` tools, without fetching the data again.
+    The table is called data and has all columns of the schema described in the tool which returned the `dataset_id`,
+    so follow-up queries can use columns the first query didn't.
+    Datasets are dropped after a while without queries or when memory runs low,
+    in that case run the original tool again.
+    Args:
+        dataset_id (str): `dataset_id` returned by an `aggregate_*` tool
+        sql_query (str): sqlite syntax query to aggregate data
+    Returns:
+        dict: `result` of the query, `truncated` and `aborted` as in `aggregate_*` tools, and the same `dataset_id`
+    """
+    dataset = await db_executor.run(datasets.get, dataset_id)
+    aggregate = await dataset.query(sql_query)
+    return {"dataset_id": dataset_id, **aggregate.as_dict()}
+
+
+async def close_dataset(dataset_id: str):
+    """
+    Drop a dataset returned by an `aggregate_*` tool once no more queries over it are needed.
+    Args:
+        dataset_id (str): `dataset_id` returned by an `aggregate_*` tool
+    Returns:
+        bool: whether the dataset was still open
+    """
+    return await db_executor.run(datasets.close, dataset_id)
@@ -1,6 +1,9 @@
-from src.core.connector import fetch_stats, fetch_block
+from src.core.connector import fetch_block, RequestProfile
+from src.core.stats import stats_snapshot
 from src.core.utils import reformat_time
 
+OVERVIEW_PROFILE = RequestProfile(("block",))  # events counts per module are in the block section
+
 
 async def get_block_overview(blockchain: str, height: int):
     """
@@ -10,9 +13,9 @@ async def get_block_overview(blockchain: str, height: int):
     :return: Description with main details about requested block within provided blockchain.
     Details include number of confirmations, block hash, block time and number of individual transfers within the block.
     """
-    block_info = await fetch_block(blockchain, height)
+    block_info = await fetch_block(blockchain, height, OVERVIEW_PROFILE)
 
-    best_block = block_info['mixins']['stats'][blockchain]['best_block']
+    best_block = await stats_snapshot.best_block(blockchain, at_least=height)
     if best_block < height:
         return f"The {blockchain.capitalize()} block {height} hasn't been processed yet."
     block_timestamp = reformat_time(block_info['data']['block']['time'])
@@ -37,14 +40,15 @@ async def get_block_info(blockchain: str, height: int):
     return block_info
 
 
-async def get_latest_block(blockchain: str):
+async def get_latest_block(blockchain: str, force_refresh: bool = False):
     """
     Fetch the height(block id) of the latest(best) block in the requested blockchain.
     :param blockchain: Lowercase blockchain name with dashes instead of spaces.
+    :param force_refresh: Ask the API for the latest block right away. Otherwise the height comes from stats
+        polled every few seconds, so it can be behind. Use it only when the freshest height matters, e.g. waiting for a new block.
     :return: Returns a number which is the latest block id in the provided blockchain.
     """
-    stats = await fetch_stats(blockchain)
-    return stats['data']['blockchains'][blockchain]['best_block']  # add time?
+    return await stats_snapshot.best_block(blockchain, force_refresh=force_refresh)  # add time?
 
 
 if __name__ == "__main__":
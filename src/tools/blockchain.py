@@ -1,4 +1,9 @@
+import asyncio
+
+from src.core.config import config
 from src.core.connector import search_string
+from src.tools.address import get_address_overview
+from src.tools.transaction import get_transaction_overview
 
 
 async def detect_blockchains(data: str) -> [str]:
@@ -12,3 +17,34 @@ async def detect_blockchains(data: str) -> [str]:
     if not blockchain_links:
         return []
     return list(blockchain_links.keys())
+
+
+async def get_cross_chain_overview(data: str) -> dict[str, str]:
+    """
+    Get main information about an address or a transaction in every blockchain it's found in, at once.
+    Use it instead of `detect_blockchains` followed by an overview call for each blockchain.
+    :param data: A plain address or a transaction hash. Must not be ENS domain.
+    :return: Blockchains with the same descriptions as `get_address_overview` or `get_transaction_overview` give.
+    Blockchains which failed or didn't answer in time have the reason instead, the rest are still returned.
+    """
+    search_results = await search_string(data)
+    blockchain_links = search_results.get('data', {}).get('results') or {}
+    overview_tools = {"address": get_address_overview, "transaction": get_transaction_overview}
+    semaphore = asyncio.Semaphore(config.cross_chain_concurrency)
+
+    async def overview(blockchain: str, entity: str, link: str) -> str:
+        # the timeout doesn't include waiting for other blockchains
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(overview_tools[entity](blockchain, link.rsplit("/", 1)[-1]),
+                                              config.cross_chain_timeout)
+            except TimeoutError:
+                return (f"No answer within {config.cross_chain_timeout} seconds, "
+                        f"call `get_{entity}_overview` for this blockchain later.")
+            except Exception as e:
+                return f"Failed to get the {entity} overview: {e}"
+
+    found = [(blockchain, entity, link) for blockchain, entity_link in blockchain_links.items()
+             for entity, link in entity_link.items() if entity in overview_tools]
+    overviews = await asyncio.gather(*(overview(*target) for target in found))
+    return {blockchain: text for (blockchain, _, _), text in zip(found, overviews)}
@@ -1,4 +1,4 @@
-from src.core.connector import fetch_stats
+from src.core.stats import stats_snapshot
 
 
 async def list_blockchains_and_modules() -> dict:
@@ -8,7 +8,7 @@ async def list_blockchains_and_modules() -> dict:
         dict: list of blockchains with their modules. Each module will have a description of it.
     """
     # TODO: there is a lot of repetition in response. Can extract main info so client LLM will spend less tokens.
-    stats = await fetch_stats()
+    stats = await stats_snapshot.get()
     library_blockchains = stats['library']['blockchains']
     library_modules = stats['library']['modules']
     blockchain_modules = {
@@ -1,6 +1,9 @@
-from src.core.connector import fetch_transaction, fetch_stats
+from src.core.connector import fetch_transaction, RequestProfile
+from src.core.stats import stats_snapshot
 from src.core.utils import reformat_time
 
+OVERVIEW_PROFILE = RequestProfile(("transaction",))  # events counts per module are in the transaction section
+
 
 async def get_transaction_info(blockchain: str, transaction_hash: str):
     transaction_info = await fetch_transaction(blockchain, transaction_hash)
@@ -13,8 +16,8 @@ async def get_transactions_count_24h(blockchain: str):
     :param blockchain: Lowercase blockchain name with dashes instead of spaces.
     :return: Dictionary with modules and corresponding number of transfers for last 24 hours.
     """
-    stats = await fetch_stats(blockchain)
-    return stats['data']['blockchains'][blockchain]['events_24h']
+    blockchain_stats = await stats_snapshot.blockchain_stats(blockchain)
+    return blockchain_stats['events_24h']
 
 
 async def get_transaction_fee_24h_usd(blockchain: str) -> int:
@@ -23,8 +26,8 @@ async def get_transaction_fee_24h_usd(blockchain: str) -> int:
     :param blockchain: Lowercase blockchain name with dashes instead of spaces.
     :return: the average fee for transactions in last 24 hours in USD.
     """
-    stats = await fetch_stats(blockchain)
-    return stats['data']['blockchains'][blockchain]['average_fee_24h']['usd']
+    blockchain_stats = await stats_snapshot.blockchain_stats(blockchain)
+    return blockchain_stats['average_fee_24h']['usd']
 
 
 async def get_mempool_transactions_count(blockchain: str) -> dict[str, int]:
@@ -33,8 +36,8 @@ async def get_mempool_transactions_count(blockchain: str) -> dict[str, int]:
     :param blockchain: Lowercase blockchain name with dashes instead of spaces.
     :return: Dictionary with modules and corresponding number of transfers in memory pool of provided blockchain.
     """
-    stats = await fetch_stats(blockchain)
-    return stats['data']['blockchains'][blockchain]['mempool_events']
+    blockchain_stats = await stats_snapshot.blockchain_stats(blockchain)
+    return blockchain_stats['mempool_events']
 
 
 async def get_transaction_overview(blockchain: str, transaction_hash: str):
@@ -46,9 +49,9 @@ async def get_transaction_overview(blockchain: str, transaction_hash: str):
     Details such as included block, number of confirmations, number of individual transfers in it
     """
 
-    transaction_info = await fetch_transaction(blockchain, transaction_hash)
-    best_block = transaction_info['mixins']['stats'][blockchain]['best_block']
+    transaction_info = await fetch_transaction(blockchain, transaction_hash, OVERVIEW_PROFILE)
     included_block = transaction_info['data']['transaction']['block']
+    best_block = await stats_snapshot.best_block(blockchain, at_least=included_block)
     transaction_time = reformat_time(transaction_info['data']['transaction']['time'])
     module_events_text = ""
     for module, events_count in transaction_info['data']['transaction']['events'].items():
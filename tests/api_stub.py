@@ -0,0 +1,37 @@
+"""
+Stand-in for the 3xpl API behind `connector._get_json`, counting requests.
+"""
+from typing import Optional
+
+CURRENCY = "ethereum"
+
+
+def event(block: int) -> dict:
+    return {"block": block, "transaction": f"0x{block:x}", "time": f"2024-01-01T00:00:00.000Z",
+            "currency": CURRENCY, "effect": "1", "failed": False, "extra": None, "sort_key": block}
+
+
+class AddressEventsApi:
+    """
+    Serves `events` of addresses, newest first, paged by `limit` and `page` like the API does.
+    """
+
+    def __init__(self):
+        self.blocks: dict[str, list[int]] = {}  # address -> blocks of its events, newest first
+        self.requests: list[tuple[str, int]] = []  # (address, page)
+
+    def add_events(self, address: str, blocks: list[int]):
+        self.blocks[address] = sorted([*blocks, *self.blocks.get(address, [])], reverse=True)
+
+    def pages_of(self, address: str) -> list[int]:
+        return [page for requested, page in self.requests if requested == address]
+
+    async def get_json(self, path: str, params: dict, ttl_policy, timeout: Optional[object] = None) -> dict:
+        address = path.split("/")[3]
+        limit, page = params["limit"], params["page"]
+        self.requests.append((address, page))
+        rows = [event(block) for block in self.blocks.get(address, [])[page * limit:(page + 1) * limit]]
+        return {
+            "data": {"events": {params["from"]: rows}},
+            "library": {"currencies": {CURRENCY: {"symbol": "ETH", "decimals": 18}}, "rates": {}},
+        }
@@ -0,0 +1,61 @@
+import functools
+import unittest
+from unittest import mock
+
+from src.core import connector
+from src.core.config import config
+from src.core.connector import fetch_address_data
+from src.core.enums import AddressDataSource
+from src.core.utils import iter_pages
+from tests.api_stub import AddressEventsApi
+
+
+class IterPagesTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.api = AddressEventsApi()
+        patcher = mock.patch.object(connector, "_get_json", self.api.get_json)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def load(self, address: str, **kwargs) -> int:
+        fetcher = functools.partial(fetch_address_data, blockchain="ethereum", module="ethereum-main",
+                                    address=address, source=AddressDataSource.events)
+        rows = 0
+        async for page in iter_pages(fetcher, ["data", "events", "ethereum-main"], get_currency_info=True,
+                                     stop_after_first=False, **kwargs):
+            rows += len(page)
+        return rows
+
+    async def test_short_first_page_is_the_only_request(self):
+        self.api.add_events("a", list(range(300)))
+        self.assertEqual(await self.load("a"), 300)
+        self.assertEqual(self.api.pages_of("a"), [0])
+
+    async def test_address_without_events_is_one_request(self):
+        self.assertEqual(await self.load("a"), 0)
+        self.assertEqual(self.api.pages_of("a"), [0])
+
+    async def test_prefetching_ramps_up_after_full_page(self):
+        self.api.add_events("a", list(range(1000)))
+        self.assertEqual(await self.load("a"), 1000)
+        self.assertEqual(self.api.pages_of("a"), [0, 1])
+
+        self.api.add_events("b", list(range(3500)))
+        self.assertEqual(await self.load("b"), 3500)
+        # the window doubles with each page: 1, then 2, then 4 pages in flight at most
+        self.assertLessEqual(max(self.api.pages_of("b")), 5)
+
+    async def test_pages_without_known_size_end_on_empty_page(self):
+        self.api.add_events("a", list(range(300)))
+        self.assertEqual(await self.load("a", page_size=None), 300)
+        self.assertEqual(self.api.pages_of("a"), [0, 1])
+
+    async def test_pagination_limit(self):
+        self.api.add_events("a", list(range(10_000)))
+        with mock.patch.object(config, "pagination_limit", 2):
+            self.assertEqual(await self.load("a", concurrency=0), 4000)
+        self.assertEqual(self.api.pages_of("a"), [0, 1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import functools
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from src.core import connector
+from src.core.config import config
+from src.core.connector import fetch_address_data
+from src.core.enums import AddressDataSource
+from src.core.stats import stats_snapshot
+from src.core.warehouse import EventWarehouse
+from tests.api_stub import AddressEventsApi
+
+MODULE = "ethereum-main"
+
+
+class EventWarehouseTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.api = AddressEventsApi()
+        self.best_block = 1_000_000
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.warehouse = EventWarehouse(Path(directory.name) / "warehouse.db", max_bytes=1 << 30)
+        self.addCleanup(lambda: self.warehouse.conn.close())
+
+        async def best_block(blockchain, at_least=None, force_refresh=False):
+            return self.best_block
+
+        for patcher in (
+            mock.patch.object(connector, "_get_json", self.api.get_json),
+            mock.patch.object(stats_snapshot, "best_block", best_block),
+            mock.patch.object(config, "pagination_limit", 2),  # 4 pages at most
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def sync(self, address: str):
+        fetcher = functools.partial(fetch_address_data, blockchain="ethereum", module=MODULE, address=address,
+                                    source=AddressDataSource.events)
+        await self.warehouse.sync_address("ethereum", MODULE, address, fetcher)
+
+    def load(self, *addresses: str) -> list[int]:
+        conn = sqlite3.connect(":memory:")
+        self.warehouse.load_into(conn, {"block": "INT"}, "ethereum", *((MODULE, address) for address in addresses))
+        return [row[0] for row in conn.execute("SELECT block FROM data")]
+
+    def stored_addresses(self) -> set[str]:
+        return {row[0] for row in self.warehouse.conn.execute("SELECT DISTINCT address FROM events")}
+
+    async def test_sync_fetches_only_new_pages(self):
+        self.api.add_events("a", list(range(1, 1501)))
+        await self.sync("a")
+        self.assertEqual(self.api.pages_of("a"), [0, 1])
+        self.assertEqual(self.warehouse.newest_block("ethereum", MODULE, "a"), 1500)
+
+        self.api.requests.clear()
+        self.api.add_events("a", list(range(1501, 1511)))
+        await self.sync("a")
+        self.assertEqual(self.api.pages_of("a"), [0])
+        self.assertEqual(sorted(self.load("a")), list(range(1, 1511)))
+
+    async def test_capped_history_stays_synced(self):
+        self.api.add_events("a", list(range(1, 5001)))
+        await self.sync("a")
+        self.assertEqual(self.api.pages_of("a"), [0, 1, 2, 3])
+        self.assertEqual(self.warehouse.newest_block("ethereum", MODULE, "a"), 5000)
+
+        self.api.requests.clear()
+        await self.sync("a")
+        self.assertEqual(self.api.pages_of("a"), [0])
+        self.assertEqual(len(self.load("a")), 4000)
+
+    async def test_cut_sync_leaves_no_gap(self):
+        self.api.add_events("a", list(range(1, 101)))
+        await self.sync("a")
+        self.api.add_events("a", list(range(1001, 6001)))
+        await self.sync("a")
+        # events between the fetched pages and the first sync are missing, so the first sync's events are dropped
+        self.assertEqual(sorted(self.load("a")), list(range(2001, 6001)))
+        self.assertEqual(self.warehouse.newest_block("ethereum", MODULE, "a"), 6000)
+
+    async def test_address_without_events_stays_synced(self):
+        for _ in range(3):
+            await self.sync("a")
+            self.assertEqual(self.warehouse.newest_block("ethereum", MODULE, "a"), -1)
+        self.assertEqual(self.api.pages_of("a"), [0, 0, 0])
+
+    async def test_reorganizable_blocks_are_fetched_again(self):
+        self.api.add_events("a", list(range(1, 301)))
+        self.best_block = 250 + config.finality_confirmations
+        await self.sync("a")
+        self.assertEqual(self.warehouse.newest_block("ethereum", MODULE, "a"), 250)
+        self.assertEqual(len(self.load("a")), 300)
+
+        await self.sync("a")
+        self.assertEqual(sorted(self.load("a")), list(range(1, 301)))
+
+    async def test_eviction_holds_max_bytes(self):
+        self.api.add_events("busy", list(range(1, 3001)))
+        self.api.add_events("small", [1, 2, 3])
+        await self.sync("busy")
+        # events of a sync that didn't finish
+        self.warehouse._insert_events(("ethereum", MODULE, "orphan"), [{"block": 1}] * 1000)
+        await self.sync("small")
+
+        self.warehouse.max_bytes = 1
+        self.assertEqual(sorted(self.load("small")), [1, 2, 3])
+        self.assertEqual(self.stored_addresses(), {"small"})
+
+    async def test_eviction_keeps_loaded_batch(self):
+        for address in "abc":
+            self.api.add_events(address, list(range(1, 1001)))
+            await self.sync(address)
+        self.api.add_events("cold", list(range(1, 1001)))
+        await self.sync("cold")
+        self.warehouse.max_bytes = 1
+
+        self.assertEqual(len(self.load("a", "b", "c")), 3000)
+        self.assertEqual(self.stored_addresses(), {"a", "b", "c"})
+
+
+if __name__ == "__main__":
+    unittest.main()